@@ -1,13 +1,16 @@
-import zmq
-import msgpack
 import time
 import json
 import os
 import random
+import sys
 import threading
 
-SERVER = os.getenv("SERVER_HOST", "server_1")
-PORT_REQ = 5555
+# No Docker cluster_client.py é copiado para /app; rodando do repositório, vem de common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from cluster_client import ClusterClient, ClusterUnavailable
+
+# Usados só se o serviço de referência não responder
+SERVER_HOSTS = os.getenv("SERVER_HOSTS", os.getenv("SERVER_HOST", "server_1")).split(",")
 
 # Relógio lógico
 logical_clock = 0
@@ -28,29 +31,13 @@ def update_clock(received_clock):
         return logical_clock
 
 
-def send_msgpack(sock, obj):
-    data = msgpack.packb(obj, use_bin_type=True)
-    sock.send(data)
-
-
-def recv_msgpack(sock):
-    data = sock.recv()
-    return msgpack.unpackb(data, raw=False)
-
-
-def send_request(socket, service, data):
-    # Adiciona relógio lógico antes de enviar
-    clock = increment_clock()
-    data["clock"] = clock
-    msg = {"service": service, "data": data}
-    print(f"[BOT-REQ] Enviando {service}: {msg}")
-    send_msgpack(socket, msg)
-    reply = recv_msgpack(socket)
-    
-    # Atualiza relógio lógico ao receber resposta
-    received_clock = reply.get("data", {}).get("clock", 0)
-    if received_clock > 0:
-        update_clock(received_clock)
+def send_request(cluster, service, data):
+    # O ClusterClient escolhe a réplica, cuida do relógio lógico e do failover
+    print(f"[BOT-REQ] Enviando {service}: {data}")
+    try:
+        reply = cluster.request(service, data)
+    except ClusterUnavailable as e:
+        reply = {"service": service, "data": {"status": "erro", "description": str(e)}}
     
     print(f"[BOT-REQ] Resposta ({service}): {reply}")
     return reply
@@ -59,23 +46,21 @@ def send_request(socket, service, data):
 def main():
     bot_name = os.getenv("BOT_NAME", "bot_1")
 
-    context = zmq.Context()
-    req_socket = context.socket(zmq.REQ)
-    req_socket.connect(f"tcp://{SERVER}:{PORT_REQ}")
-    print(f"[BOT] {bot_name} conectado a tcp://{SERVER}:{PORT_REQ}")
+    cluster = ClusterClient(increment_clock, update_clock, fallback=SERVER_HOSTS)
+    print(f"[BOT] {bot_name} usando os servidores ativos do serviço de referência")
 
     # login
-    login_resp = send_request(req_socket, "login", {"user": bot_name, "timestamp": time.time()})
+    login_resp = send_request(cluster, "login", {"user": bot_name, "timestamp": time.time()})
     print(f"[BOT] Login realizado: {login_resp}")
 
     # Cria um canal padrão se não existir
     default_channel = "Geral"
-    channels_resp = send_request(req_socket, "channels", {"timestamp": time.time()})
+    channels_resp = send_request(cluster, "channels", {"timestamp": time.time()})
     channels = channels_resp.get("data", {}).get("channels", [])
     
     if default_channel not in channels:
         print(f"[BOT] Criando canal '{default_channel}'...")
-        create_resp = send_request(req_socket, "channel", {"channel": default_channel, "timestamp": time.time()})
+        create_resp = send_request(cluster, "channel", {"channel": default_channel, "timestamp": time.time()})
         print(f"[BOT] Canal criado: {create_resp}")
         channels.append(default_channel)
     
@@ -87,14 +72,14 @@ def main():
     while True:
         cycle_count += 1
         # Lista canais novamente (pode ter mudado)
-        resp = send_request(req_socket, "channels", {"timestamp": time.time()})
+        resp = send_request(cluster, "channels", {"timestamp": time.time()})
         channels = resp.get("data", {}).get("channels", [])
         
         if not channels:
             # Se não há canais, cria um
             channel_name = default_channel
             print(f"[BOT] Nenhum canal disponível. Criando '{channel_name}'...")
-            create_resp = send_request(req_socket, "channel", {"channel": channel_name, "timestamp": time.time()})
+            create_resp = send_request(cluster, "channel", {"channel": channel_name, "timestamp": time.time()})
             if create_resp.get("data", {}).get("status") == "sucesso":
                 channels = [channel_name]
                 print(f"[BOT] Canal '{channel_name}' criado com sucesso!")
@@ -110,7 +95,7 @@ def main():
         # Envia mensagem
         msg_text = f"{bot_name} msg {cycle_count} no canal {channel}"
         publish_resp = send_request(
-            req_socket,
+            cluster,
             "publish",
             {
                 "user": bot_name,
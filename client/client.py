@@ -1,16 +1,28 @@
 import zmq
-import msgpack
 import time
 import threading
 import queue
 import sys
+import os
+
+# No Docker cluster_client.py e codec.py são copiados para /app; rodando do repositório, vêm de common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from cluster_client import ClusterClient, ClusterUnavailable
+from codec import recv_multipart_msgpack
 
 PROXY = "proxy"
-SERVER = "server"
-PORT_REQ = 5555
+# Usados só se o serviço de referência não responder
+SERVER_HOSTS = os.getenv("SERVER_HOSTS", "server_1,server_2,server_3").split(",")
 PORT_SUB = 5558
+HISTORY_LIMIT = 50  # Últimas mensagens carregadas ao entrar num canal
 
 sub_commands = queue.Queue()
+# Cursor do histórico por canal (devolvido pelo servidor): ao voltar a um
+# canal só as mensagens perdidas são baixadas
+history_cursors = {}
+# Mensagens de canal já mostradas (ao vivo ou pelo histórico): o cursor relê
+# uma janela curta antes dele, e o que já apareceu ao vivo não é repetido
+shown_messages = {}
 
 # Relógio lógico
 logical_clock = 0
@@ -31,18 +43,40 @@ def update_clock(received_clock):
         return logical_clock
 
 
-# ---------- Helpers MsgPack ----------
-def send_msgpack(sock, obj):
-    data = msgpack.packb(obj, use_bin_type=True)
-    sock.send(data)
+# ---------- Subscriber Thread ----------
+def message_key(m):
+    # O clock muda entre réplicas; autor, texto e timestamp não
+    return (m.get("user"), m.get("message"), m.get("timestamp"))
 
 
-def recv_msgpack(sock):
-    data = sock.recv()
-    return msgpack.unpackb(data, raw=False)
+def show_message(topic, payload):
+    # Atualiza relógio lógico ao receber mensagem
+    received_clock = payload.get("clock", 0)
+    if received_clock > 0:
+        update_clock(received_clock)
+    
+    ts = time.strftime(
+        "%H:%M:%S", time.localtime(payload.get("timestamp", time.time()))
+    )
+    # Detecta se é mensagem privada ou de canal
+    if payload.get("dst"):
+        # Mensagem privada recebida (só recebemos mensagens no nosso próprio tópico)
+        src = payload.get("src") or payload.get("user")
+        msg_txt = payload.get("message")
+        print(
+            f"\n[{ts}] [PRIVADA de {src}]: {msg_txt}\n> ",
+            end="",
+        )
+    else:
+        # Mensagem de canal
+        if topic in shown_messages:
+            shown_messages[topic].add(message_key(payload))
+        print(
+            f"\n[{ts}] ({topic}) {payload.get('user')}: {payload.get('message')}\n> ",
+            end="",
+        )
 
 
-# ---------- Subscriber Thread ----------
 def subscriber_thread():
     ctx = zmq.Context()
     sub = ctx.socket(zmq.SUB)
@@ -66,51 +100,28 @@ def subscriber_thread():
         socks = dict(poller.poll(100))
         if sub in socks and socks[sub] == zmq.POLLIN:
             try:
-                frames = sub.recv_multipart()
-                if len(frames) < 2:
+                received = recv_multipart_msgpack(sub)
+                if received is None:
                     continue
-                topic = frames[0].decode()
-                payload = msgpack.unpackb(frames[1], raw=False)
-                # Atualiza relógio lógico ao receber mensagem
-                received_clock = payload.get("clock", 0)
-                if received_clock > 0:
-                    update_clock(received_clock)
-                
-                ts = time.strftime(
-                    "%H:%M:%S", time.localtime(payload.get("timestamp", time.time()))
-                )
-                # Detecta se é mensagem privada ou de canal
-                if payload.get("dst"):
-                    # Mensagem privada recebida (só recebemos mensagens no nosso próprio tópico)
-                    src = payload.get("src") or payload.get("user")
-                    msg_txt = payload.get("message")
-                    print(
-                        f"\n[{ts}] [PRIVADA de {src}]: {msg_txt}\n> ",
-                        end="",
-                    )
+                topic, payload = received
+                # O servidor pode agrupar várias mensagens do tópico em um lote
+                if payload.get("service") == "batch":
+                    messages = payload.get("data", {}).get("messages", [])
                 else:
-                    # Mensagem de canal
-                    print(
-                        f"\n[{ts}] ({topic}) {payload.get('user')}: {payload.get('message')}\n> ",
-                        end="",
-                    )
+                    messages = [payload]
+                for m in messages:
+                    show_message(topic, m)
             except Exception as e:
                 print(f"[ERRO][SUB] Falha ao decodificar mensagem: {e}")
 
 
 # ---------- REQ Helper ----------
-def send_request(sock, service, data):
-    # Adiciona relógio lógico antes de enviar
-    clock = increment_clock()
-    data["clock"] = clock
-    msg = {"service": service, "data": data}
-    send_msgpack(sock, msg)
-    resp = recv_msgpack(sock)
-    
-    # Atualiza relógio lógico ao receber resposta
-    received_clock = resp.get("data", {}).get("clock", 0)
-    if received_clock > 0:
-        update_clock(received_clock)
+def send_request(cluster, service, data):
+    # O ClusterClient escolhe a réplica, cuida do relógio lógico e do failover
+    try:
+        resp = cluster.request(service, data)
+    except ClusterUnavailable as e:
+        resp = {"service": service, "data": {"status": "erro", "description": str(e)}}
     
     print(f"[RESP] {resp}")
     return resp
@@ -118,10 +129,8 @@ def send_request(sock, service, data):
 
 # ---------- UI Terminal ----------
 def main():
-    ctx = zmq.Context()
-    req = ctx.socket(zmq.REQ)
-    req.connect(f"tcp://{SERVER}:{PORT_REQ}")
-    print(f"[CLIENT] REQ conectado em tcp://{SERVER}:{PORT_REQ}")
+    cluster = ClusterClient(increment_clock, update_clock, fallback=SERVER_HOSTS)
+    print("[CLIENT] Usando os servidores ativos do serviço de referência")
 
     # Thread do subscriber
     threading.Thread(target=subscriber_thread, daemon=True).start()
@@ -131,7 +140,13 @@ def main():
     if not user:
         print("Usuário inválido.")
         sys.exit(1)
-    send_request(req, "login", {"user": user, "timestamp": time.time()})
+    resp = send_request(cluster, "login", {"user": user, "timestamp": time.time()})
+    # Mensagens privadas recebidas enquanto estava offline
+    inbox = resp.get("data", {}).get("inbox", [])
+    if inbox:
+        print(f"[INFO] {len(inbox)} mensagens privadas recebidas enquanto offline:")
+        for m in inbox:
+            show_message(user, m)
     
     # Inscreve no próprio tópico para receber mensagens privadas
     sub_commands.put(user)
@@ -148,36 +163,45 @@ def main():
         print("5. Enviar mensagem no canal")
         print("6. Enviar mensagem privada")
         print("7. Ver histórico de mensagens privadas")
-        print("8. Sair")
+        print("8. Listar conversas privadas")
+        print("9. Sair")
         choice = input("> ").strip()
 
         if choice == "1":
-            send_request(req, "users", {})
+            send_request(cluster, "users", {})
 
         elif choice == "2":
             ch = input("Nome do canal: ").strip()
             if ch:
-                send_request(req, "channel", {"channel": ch})
+                send_request(cluster, "channel", {"channel": ch})
 
         elif choice == "3":
-            send_request(req, "channels", {})
+            send_request(cluster, "channels", {})
 
         elif choice == "4":
             ch = input("Entrar em canal: ").strip()
             if not ch:
                 continue
-            send_request(req, "subscribe", {"user": user, "channel": ch})
+            send_request(cluster, "subscribe", {"user": user, "channel": ch})
             sub_commands.put(ch)
             current_channel = ch
 
-            # Carrega histórico
+            # Carrega histórico (só o que chegou desde a última visita, se houver cursor)
             print(f"[INFO] Carregando histórico de '{ch}'...")
-            resp = send_request(req, "history", {"channel": ch})
-            msgs = resp.get("data", {}).get("messages", [])
+            if ch in history_cursors:
+                resp = send_request(cluster, "history", {"channel": ch, "since": history_cursors[ch]})
+            else:
+                resp = send_request(cluster, "history", {"channel": ch, "limit": HISTORY_LIMIT})
+            data = resp.get("data", {})
+            shown = shown_messages.setdefault(ch, set())
+            msgs = [m for m in data.get("messages", []) if message_key(m) not in shown]
+            shown.update(message_key(m) for m in msgs)
+            if data.get("status") == "sucesso":
+                history_cursors[ch] = data.get("cursor")
             if not msgs:
-                print(f"[INFO] Nenhuma mensagem anterior em '{ch}'.")
+                print(f"[INFO] Nenhuma mensagem nova em '{ch}'.")
             else:
-                print(f"[INFO] Últimas {len(msgs)} mensagens:")
+                print(f"[INFO] {len(msgs)} mensagens:")
                 for m in msgs:
                     ts = time.strftime(
                         "%H:%M:%S", time.localtime(m.get("timestamp", time.time()))
@@ -192,7 +216,7 @@ def main():
             if not msg_txt:
                 continue
             send_request(
-                req,
+                cluster,
                 "publish",
                 {
                     "user": user,
@@ -215,7 +239,7 @@ def main():
             if not msg_txt:
                 continue
             resp = send_request(
-                req,
+                cluster,
                 "message",
                 {
                     "src": user,
@@ -240,7 +264,7 @@ def main():
                 continue
             
             print(f"[INFO] Carregando histórico de mensagens privadas com '{other_user}'...")
-            resp = send_request(req, "private_history", {"user1": user, "user2": other_user})
+            resp = send_request(cluster, "private_history", {"user1": user, "user2": other_user})
             msgs = resp.get("data", {}).get("messages", [])
             
             if not msgs:
@@ -270,6 +294,19 @@ def main():
                 print("-" * 60)
 
         elif choice == "8":
+            # Caixa de entrada: última mensagem de cada conversa, mais recente primeiro
+            resp = send_request(cluster, "conversations", {"user": user})
+            conversations = resp.get("data", {}).get("conversations", [])
+            if not conversations:
+                print("[INFO] Nenhuma conversa privada.")
+            for c in conversations:
+                last = c.get("last_message") or {}
+                ts = time.strftime("%H:%M:%S", time.localtime(c.get("timestamp") or time.time()))
+                unread = f" ({c['unread']} não lidas)" if c.get("unread") else ""
+                print(f"[{ts}] {c['peer']}{unread} - {c['count']} mensagens - {last.get('src')}: {last.get('message')}")
+
+        elif choice == "9":
+            send_request(cluster, "logout", {"user": user})
             print("Saindo...")
             break
 
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Cliente do cluster de servidores (usado pelo client.py e pelo bot.py)
+
+- Descobre os servidores ativos no serviço de referência (lista com cache)
+- Leituras (READ_SERVICES) são distribuídas em round-robin entre as réplicas
+- Escritas vão para uma réplica escolhida (a de menor rank viva), sempre a
+  mesma enquanto ela responder; se uma réplica somente leitura repassar a
+  escrita, as próximas vão direto ao writer que a atendeu (served_by)
+- Leituras podem pedir um atraso máximo (max_staleness_ms): réplica somente
+  leitura mais atrasada que isso repassa a leitura ao writer
+- Toda requisição tem timeout: réplica que não responde fica de fora por um
+  tempo e a requisição é refeita na próxima (failover)
+- Anuncia os algoritmos de compressão aceitos: respostas grandes (history,
+  private_history) chegam comprimidas e o codec descomprime
+"""
+import os
+import time
+import threading
+
+import zmq
+
+from codec import send_msgpack, recv_msgpack, SUPPORTED_COMPRESSION
+
+REFERENCE_HOST = os.getenv("REFERENCE_HOST", "reference")
+REFERENCE_PORT = 5559
+SERVER_PORT = 5555
+REQUEST_TIMEOUT = 3000  # ms por tentativa
+REFERENCE_TIMEOUT = 2000  # ms
+SERVER_LIST_TTL = 10  # Segundos de cache da lista de servidores
+DOWN_BACKOFF = 5  # Segundos que uma réplica sem resposta fica fora do rodízio
+
+READ_SERVICES = {"users", "channels", "history", "private_history", "sync", "search", "unread", "conversations"}
+
+
+class ClusterUnavailable(Exception):
+    """Nenhum servidor respondeu à requisição"""
+
+
+class ClusterClient:
+    """Roteia requisições REQ/REP entre as réplicas com failover.
+
+    increment_clock/update_clock são os do relógio lógico de quem usa a
+    biblioteca (o cliente continua dono do seu relógio de Lamport)."""
+
+    def __init__(self, increment_clock, update_clock, fallback=None,
+                 reference_host=REFERENCE_HOST, timeout=REQUEST_TIMEOUT, max_staleness_ms=None,
+                 compression=SUPPORTED_COMPRESSION):
+        self.ctx = zmq.Context.instance()
+        self.increment_clock = increment_clock
+        self.update_clock = update_clock
+        self.reference_addr = f"tcp://{reference_host}:{REFERENCE_PORT}"
+        # Servidores usados enquanto o serviço de referência não responder
+        self.fallback = list(fallback or [])
+        self.timeout = timeout
+        self.max_staleness_ms = max_staleness_ms
+        self.compression = list(compression or [])  # Vazio: nunca pede compressão
+        self.lock = threading.Lock()  # Sockets REQ não podem ser compartilhados
+        self.sockets = {}  # servidor -> REQ
+        self.servers = []  # [(rank, nome)] ordenado por rank
+        self.updated = 0
+        self.down_until = {}  # servidor -> instante em que volta ao rodízio
+        self.next_read = 0
+        self.writer = None
+
+    # ---------- Descoberta ----------
+    def _fetch_server_list(self):
+        sock = self.ctx.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.reference_addr)
+        try:
+            msg = {"service": "list", "data": {"timestamp": time.time(), "clock": self.increment_clock()}}
+            send_msgpack(sock, msg)
+            if not sock.poll(REFERENCE_TIMEOUT, zmq.POLLIN):
+                return None
+            resp = recv_msgpack(sock)
+        finally:
+            sock.close()
+        data = resp.get("data", {})
+        self.update_clock(data.get("clock", 0))
+        return sorted((s.get("rank", 999), s.get("name")) for s in data.get("list") or [] if s.get("name"))
+
+    def _live_servers(self):
+        """Servidores em ordem de rank, sem os que estão em backoff"""
+        now = time.time()
+        if not self.servers or now - self.updated > SERVER_LIST_TTL:
+            servers = self._fetch_server_list()
+            if servers:
+                self.servers = servers
+            elif not self.servers:
+                self.servers = [(i, name) for i, name in enumerate(self.fallback)]
+            self.updated = now
+        names = [name for _, name in self.servers]
+        live = [name for name in names if self.down_until.get(name, 0) <= now]
+        # Todos em backoff: tenta assim mesmo (melhor que desistir sem tentar)
+        return live or names
+
+    def _candidates(self, service):
+        live = self._live_servers()
+        if not live:
+            return []  # Referência fora do ar e sem fallback: request() levanta ClusterUnavailable
+        if service in READ_SERVICES:
+            # Leitura: começa na próxima réplica do rodízio
+            start = self.next_read % len(live)
+            self.next_read += 1
+            return live[start:] + live[:start]
+        # Escrita: réplica fixa enquanto responder (a de menor rank viva)
+        if self.writer not in live:
+            self.writer = live[0]
+        return [self.writer] + [name for name in live if name != self.writer]
+
+    # ---------- Requisições ----------
+    def _socket(self, server):
+        sock = self.sockets.get(server)
+        if sock is None:
+            sock = self.ctx.socket(zmq.REQ)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(f"tcp://{server}:{SERVER_PORT}")
+            self.sockets[server] = sock
+        return sock
+
+    def _drop(self, server):
+        sock = self.sockets.pop(server, None)
+        if sock is not None:
+            sock.close()  # REQ sem resposta fica travado: descarta e recria
+        self.down_until[server] = time.time() + DOWN_BACKOFF
+        if self.writer == server:
+            self.writer = None
+
+    def request(self, service, data):
+        """Envia a requisição e devolve a resposta; faz failover entre as
+        réplicas e levanta ClusterUnavailable se nenhuma responder"""
+        with self.lock:
+            candidates = self._candidates(service)
+            if not candidates:
+                raise ClusterUnavailable("Nenhum servidor conhecido")
+            if service in READ_SERVICES and self.max_staleness_ms is not None:
+                data.setdefault("max_staleness_ms", self.max_staleness_ms)
+            for server in candidates:
+                data["clock"] = self.increment_clock()
+                sock = self._socket(server)
+                send_msgpack(sock, {"service": service, "data": data, "compression": self.compression})
+                if not sock.poll(self.timeout, zmq.POLLIN):
+                    print(f"[CLUSTER] {server} não respondeu a '{service}' em {self.timeout}ms, tentando outro")
+                    self._drop(server)
+                    continue
+                resp = recv_msgpack(sock)
+                self.down_until.pop(server, None)
+                received_clock = resp.get("data", {}).get("clock", 0)
+                if received_clock > 0:
+                    self.update_clock(received_clock)
+                served_by = resp.get("data", {}).get("served_by")
+                if service not in READ_SERVICES and served_by in candidates:
+                    self.writer = served_by  # Réplica repassou: escreve direto no writer
+                return resp
+            raise ClusterUnavailable(f"Nenhum servidor respondeu a '{service}'")
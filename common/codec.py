@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Codificação MsgPack dos frames ZeroMQ (usado pelo servidor, cliente e bot)
+
+- Envio: corpo entregue ao ZeroMQ com copy=False (frames grandes não são
+  copiados de novo para dentro do libzmq)
+- Recebimento: frame com copy=False, decodificado direto do buffer do ZeroMQ
+  (memoryview), sem criar um bytes intermediário
+- Packer reaproveitado por thread (msgpack.Packer não é thread-safe), também
+  usado por quem monta frames a partir de partes já codificadas. Economiza
+  alocação só em frames pequenos/médios; em respostas grandes o pico de
+  memória e o tempo são os mesmos do packb (ver scripts/bench_codec.py)
+- Compressão negociada: quem aceita anuncia os algoritmos em "compression" no
+  envelope do pedido; frames acima de COMPRESSION_THRESHOLD vão como
+  {"compression": algoritmo, "body": frame comprimido}, desfeito pelo unpack
+  com limite de tamanho (MAX_FRAME_SIZE). Só respostas, replicação e snapshot
+  vêm comprimidos: quem recebe pedidos de clientes usa compressed=False
+"""
+import os
+import lzma
+import zlib
+import threading
+
+import msgpack
+
+COMPRESSION_THRESHOLD = int(os.getenv("COMPRESSION_THRESHOLD", "8192"))  # Bytes
+# Maior frame descomprimido aceito: um frame pequeno e muito repetitivo não
+# pode virar gigabytes na memória de quem recebe
+MAX_FRAME_SIZE = int(os.getenv("MAX_FRAME_SIZE", str(64 * 1024 * 1024)))  # Bytes
+
+
+def _bounded(decompressor):
+    def decompress(body):
+        d = decompressor()
+        out = d.decompress(body, MAX_FRAME_SIZE)
+        # Sem chegar ao fim do fluxo: passou do limite (ou veio truncado)
+        if not d.eof:
+            raise ValueError(f"Frame comprimido inválido ou maior que {MAX_FRAME_SIZE} bytes")
+        return out
+    return decompress
+
+
+# Em ordem de preferência: zlib é rápido, lzma comprime mais e custa mais CPU
+COMPRESSORS = {
+    "zlib": (zlib.compress, _bounded(zlib.decompressobj)),
+    "lzma": (lzma.compress, _bounded(lzma.LZMADecompressor)),
+}
+SUPPORTED_COMPRESSION = list(COMPRESSORS)
+
+_local = threading.local()
+compression_stats = {"frames": 0, "bytes_in": 0, "bytes_out": 0}
+_stats_lock = threading.Lock()
+
+
+def thread_packer():
+    """Packer da thread atual (não compartilhar com outras threads)"""
+    packer = getattr(_local, "packer", None)
+    if packer is None:
+        packer = _local.packer = msgpack.Packer(use_bin_type=True)
+    return packer
+
+
+def pack(obj):
+    return thread_packer().pack(obj)
+
+
+def unpack(buf, compressed=True):
+    """Decodifica bytes, memoryview ou zmq.Frame sem copiar o buffer (frames
+    comprimidos são descomprimidos aqui; com compressed=False são recusados)"""
+    obj = msgpack.unpackb(getattr(buf, "buffer", buf), raw=False)
+    if isinstance(obj, dict) and len(obj) == 2 and "compression" in obj and "body" in obj:
+        if not compressed:
+            raise ValueError("Frame comprimido não aceito aqui")
+        algo = obj["compression"]
+        if not isinstance(algo, str) or algo not in COMPRESSORS:
+            raise ValueError(f"Compressão não suportada: {algo!r}")
+        obj = msgpack.unpackb(COMPRESSORS[algo][1](obj["body"]), raw=False)
+    return obj
+
+
+def compress_frame(body, accepted):
+    """Comprime um frame já codificado se passar do limite e o destino aceitar
+    algum algoritmo; senão (ou se não ficar menor) devolve o próprio frame.
+    accepted vem do envelope do pedido: qualquer coisa que não seja uma lista
+    de nomes conta como não aceitar compressão"""
+    if not isinstance(accepted, (list, tuple)) or len(body) <= COMPRESSION_THRESHOLD:
+        return body
+    algo = next((a for a in accepted if isinstance(a, str) and a in COMPRESSORS), None)
+    if algo is None:
+        return body
+    compressed = COMPRESSORS[algo][0](body)
+    if len(compressed) >= len(body):
+        return body
+    with _stats_lock:
+        compression_stats["frames"] += 1
+        compression_stats["bytes_in"] += len(body)
+        compression_stats["bytes_out"] += len(compressed)
+    return pack({"compression": algo, "body": compressed})
+
+
+def compression_status():
+    with _stats_lock:
+        return dict(compression_stats)
+
+
+def send_packed(sock, body, flags=0):
+    """Envia um corpo já codificado (ex: vindo de cache)"""
+    sock.send(body, flags, copy=False)
+
+
+def send_msgpack(sock, obj, flags=0):
+    sock.send(pack(obj), flags, copy=False)
+
+
+def recv_msgpack(sock, flags=0, compressed=True):
+    return unpack(sock.recv(flags, copy=False), compressed)
+
+
+def recv_multipart_msgpack(sock, flags=0):
+    """(tópico, payload) de um frame Pub/Sub [tópico, corpo]; None se vier
+    fora desse formato"""
+    frames = sock.recv_multipart(flags, copy=False)
+    if len(frames) < 2:
+        return None
+    return frames[0].bytes.decode(), unpack(frames[-1])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark do codec (common/codec.py) contra packb/unpackb + send/recv com cópia
+
+Mede, para respostas de history de vários tamanhos, o tempo por ida e volta
+(REQ -> REP por inproc) e os bytes alocados por requisição (tracemalloc).
+
+Uso (no host, a partir da raiz do repositório, ou no container server_1):
+    python scripts/bench_codec.py
+    docker compose exec server_1 python /scripts/bench_codec.py -n 500
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+import zmq
+import msgpack
+
+# codec.py fica em /app no container e em common/ no repositório
+sys.path.append("/app")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import codec
+
+SIZES = (10, 100, 1000, 5000)
+
+
+def history_response(n):
+    return {
+        "service": "history",
+        "data": {
+            "status": "sucesso",
+            "timestamp": time.time(),
+            "clock": 42,
+            "messages": [
+                {"user": f"user_{i % 7}", "channel": "Geral", "message": "x" * 80,
+                 "timestamp": time.time(), "clock": i}
+                for i in range(n)
+            ],
+        },
+    }
+
+
+# ---------- Variantes ----------
+def copy_send(sock, obj):
+    sock.send(msgpack.packb(obj, use_bin_type=True))
+
+
+def copy_recv(sock):
+    return msgpack.unpackb(sock.recv(), raw=False)
+
+
+VARIANTS = {
+    "packb+copia": (copy_send, copy_recv),
+    "codec": (codec.send_msgpack, codec.recv_msgpack),
+}
+
+
+def run(variant, resp, n):
+    send, recv = VARIANTS[variant]
+    ctx = zmq.Context.instance()
+    rep = ctx.socket(zmq.REP)
+    rep.bind(f"inproc://bench-{variant}")
+    req = ctx.socket(zmq.REQ)
+    req.connect(f"inproc://bench-{variant}")
+    request = {"service": "history", "data": {"channel": "Geral"}}
+
+    def once():
+        send(req, request)
+        recv(rep)
+        send(rep, resp)
+        return recv(req)
+
+    for _ in range(20):  # Aquecimento
+        once()
+    start = time.perf_counter()
+    for _ in range(n):
+        once()
+    elapsed = time.perf_counter() - start
+
+    # Pico de memória alocada durante uma requisição (packb cria um Packer
+    # novo, com buffer próprio, a cada chamada)
+    tracemalloc.start()
+    once()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    req.close()
+    rep.close()
+    return elapsed / n * 1e6, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do codec MsgPack/ZeroMQ")
+    parser.add_argument("-n", type=int, default=300, help="idas e voltas por variante")
+    args = parser.parse_args()
+
+    print(f"{'mensagens':>9s} {'bytes':>9s} {'variante':14s} {'µs/req':>9s} {'pico alocado':>13s}")
+    for size in SIZES:
+        resp = history_response(size)
+        body = len(msgpack.packb(resp, use_bin_type=True))
+        for variant in VARIANTS:
+            us, peak = run(variant, resp, args.n)
+            print(f"{size:9d} {body:9d} {variant:14s} {us:9.1f} {peak:12d}B")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de latência do publish para cada write concern (local, one, majority)
+
+Uso (dentro da rede Docker, ex: no container server_1 que monta /scripts):
+    docker compose exec server_1 python /scripts/bench_write_concern.py
+    docker compose exec server_1 python /scripts/bench_write_concern.py -n 500
+"""
+import os
+import sys
+import time
+import argparse
+
+import zmq
+import msgpack
+
+MODES = ("local", "one", "majority")
+
+
+def send_msgpack(sock, obj):
+    data = msgpack.packb(obj, use_bin_type=True)
+    sock.send(data)
+
+
+def recv_msgpack(sock):
+    data = sock.recv()
+    return msgpack.unpackb(data, raw=False)
+
+
+def request(sock, service, data):
+    send_msgpack(sock, {"service": service, "data": data})
+    return recv_msgpack(sock)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def bench_mode(sock, mode, n, user, channel):
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        resp = request(sock, "publish", {
+            "user": user,
+            "channel": channel,
+            "message": f"bench {mode} {i}",
+            "timestamp": time.time(),
+            "write_concern": mode,
+        })
+        latencies.append((time.perf_counter() - t0) * 1000)
+        if resp.get("data", {}).get("status") != "sucesso":
+            failures += 1
+    total = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "n": n,
+        "failures": failures,
+        "avg": sum(latencies) / len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "ops": n / total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de write concern do publish")
+    parser.add_argument("-n", type=int, default=200, help="publicações por modo")
+    parser.add_argument("--server", default=os.getenv("SERVER_NAME", "server_1"))
+    parser.add_argument("--channel", default="bench")
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.setsockopt(zmq.RCVTIMEO, 10000)
+    sock.connect(f"tcp://{args.server}:5555")
+
+    user = "bench_user"
+    request(sock, "login", {"user": user, "timestamp": time.time()})
+    request(sock, "channel", {"channel": args.channel, "timestamp": time.time()})
+
+    print(f"[BENCH] {args.n} publish por modo em {args.server}")
+    print(f"{'modo':10s} {'falhas':>7s} {'média':>9s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'ops/s':>9s}")
+    for mode in MODES:
+        r = bench_mode(sock, mode, args.n, user, args.channel)
+        print(
+            f"{r['mode']:10s} {r['failures']:7d} {r['avg']:8.2f}ms {r['p50']:8.2f}ms "
+            f"{r['p95']:8.2f}ms {r['p99']:8.2f}ms {r['ops']:9.1f}"
+        )
+
+    sock.close()
+    ctx.term()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
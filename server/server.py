@@ -6,10 +6,32 @@ import shutil
 import msgpack
 import threading
 import socket
+import uuid
+import hashlib
+import random
+import queue
+import math
+import struct
+import sys
+import re
+import unicodedata
+import bisect
+from collections import deque, OrderedDict, Counter
+
+# No Docker codec.py é copiado para /app; rodando do repositório, vem de common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from codec import (
+    pack, unpack, thread_packer, send_packed, send_msgpack, recv_msgpack, recv_multipart_msgpack,
+    compress_frame, compression_status, SUPPORTED_COMPRESSION,
+)
 
 DATA_DIR = "data"
 DATA_FILE = os.path.join(DATA_DIR, "data.json")
 LOGIN_FILE = os.path.join(DATA_DIR, "login.json")
+REPLICATION_FILE = os.path.join(DATA_DIR, "replication.json")
+METRICS_FILE = os.path.join(DATA_DIR, "metrics.jsonl")
+LEASE_FILE = os.path.join(DATA_DIR, "lease.json")
+SEARCH_FILE = os.path.join(DATA_DIR, "search.json")
 
 # Variáveis globais para relógio e sincronização
 logical_clock = 0
@@ -25,6 +47,69 @@ REFERENCE_PORT = 5559
 SYNC_INTERVAL = 10  # Sincronizar a cada 10 mensagens
 replication_enabled = True  # Flag para habilitar/desabilitar replicação
 replication_lock = threading.Lock()  # Lock para operações de replicação
+data_lock = threading.RLock()  # Serializa leitura-modificação-escrita do data.json
+
+# Posição de replicação: cada servidor numera suas operações (epoch + seq)
+replication_epoch = None  # Identifica a "encarnação" dos dados locais
+replication_seq = 0  # Última seq local publicada
+replication_applied = {}  # origem -> {"epoch": ..., "seq": ...} já aplicados
+
+# Transferência de estado (snapshot) para bootstrap de réplicas novas
+SNAPSHOT_PORT = 5556
+SNAPSHOT_CHUNK_SIZE = 64 * 1024  # Bytes por chunk
+SNAPSHOT_PIPELINE = 8  # Chunks em voo (controle de fluxo por créditos)
+SNAPSHOT_TIMEOUT = 5000  # ms sem resposta antes de desistir do peer
+SNAPSHOT_TTL = 60  # Segundos que um snapshot fica disponível
+snapshots = {}  # id -> {"blob": bytes, "created": ts}
+bootstrapping = False  # Enquanto True, replicações recebidas ficam em buffer
+bootstrap_buffer = []
+bootstrap_lock = threading.Lock()
+
+# Anti-entropia: digest (Merkle) das mensagens por conversa e janela de tempo
+DIGEST_BUCKET_SECONDS = 3600  # Largura de cada bucket de tempo
+ANTI_ENTROPY_INTERVAL = 30  # Segundos entre comparações com um peer
+message_digest = {}  # chave (canal/conversa) -> {bucket: [soma_hashes, qtd]}
+digest_lock = threading.Lock()
+
+# Confirmação de escrita (write concern) em publish/message
+WRITE_CONCERNS = ("local", "one", "majority")
+QUORUM_TIMEOUT = int(os.getenv("QUORUM_TIMEOUT_MS", "1000"))  # ms
+QUORUM_PORT = 5562  # ROUTER que recebe as cópias diretas e devolve os acks
+PEER_LIST_TTL = 10  # Segundos de cache da lista de peers
+peer_cache = {"peers": [], "updated": 0}
+ELECTION_TIMEOUT = 2000  # ms: prazo total da rodada de eleição
+election_running = threading.Event()
+election_lock = threading.Lock()
+last_election = {}  # Duração/resultado da última eleição (failover medido)
+quorum_sockets = {}  # peer -> DEALER (usado apenas pela thread principal)
+
+# Papel do servidor: "primary" aceita tudo; "replica" só serve leituras e
+# encaminha escritas ao writer (WRITER_HOST ou, se vazio, o coordenador)
+SERVER_ROLE = os.getenv("SERVER_ROLE", "primary").lower()
+WRITER_HOST = os.getenv("WRITER_HOST", "")
+WRITE_SERVICES = {"login", "logout", "channel", "subscribe", "publish", "message", "mark_read"}
+READ_SERVICES = {"users", "channels", "history", "private_history", "sync", "search", "unread", "conversations"}
+peer_positions = {}  # peer -> última posição anunciada no heartbeat + quando a alcançamos
+
+# Lease do coordenador com fencing token
+LEASE_DURATION = 6.0  # Segundos de validade de cada concessão
+LEASE_RENEW_INTERVAL = 2.0  # Coordenador renova bem antes de expirar
+# Protegido por coordinator_lock. "token" é o do lease atual e "max_token" o
+# maior já visto (persistido em lease.json para nunca voltar atrás)
+lease = {"coordinator": None, "token": 0, "rank": None, "expires": 0.0, "max_token": 0}
+lease_changed = threading.Event()  # Acorda a lease_thread ao receber/renovar
+
+# Malha de replicação direta entre servidores (sem passar pelo proxy)
+REPLICATION_MESH = os.getenv("REPLICATION_MESH", "0").lower() in ("1", "true", "yes")
+MESH_PORT = 5560
+
+# Métricas de replicação por origem (lag, latência, fila, vazão)
+METRICS_INTERVAL = 10  # Segundos entre amostras gravadas em metrics.jsonl
+METRICS_MAX_BYTES = 1024 * 1024  # Rotaciona metrics.jsonl ao passar disso
+RATE_WINDOW = 10  # Janela (s) para o cálculo de ops/s
+replication_queue = queue.Queue()  # Operações recebidas aguardando aplicação
+replication_metrics = {}  # origem -> métricas
+metrics_lock = threading.Lock()
 
 
 # ---------- Relógio Lógico ----------
@@ -47,15 +132,86 @@ def get_clock():
         return logical_clock
 
 
-# ---------- MsgPack helpers ----------
-def send_msgpack(sock, obj):
-    data = msgpack.packb(obj, use_bin_type=True)
-    sock.send(data)
+# ---------- Publicador único ----------
+PUBLISHER_ADDR = "inproc://publisher"
+publisher_local = threading.local()  # PUSH de cada thread para o publicador
+# Agrupamento de mensagens de canal/privadas: 0 desliga (um frame por mensagem)
+PUBLISH_COALESCE_MS = int(os.getenv("PUBLISH_COALESCE_MS", "0"))
+COALESCE_MAX_BATCH = 64  # Mensagens por lote antes de enviar sem esperar o prazo
 
 
-def recv_msgpack(sock):
-    data = sock.recv()
-    return msgpack.unpackb(data, raw=False)
+def batch_frame(items):
+    """Monta {"service": "batch", "data": {"messages": [...]}} concatenando os
+    payloads já codificados, sem decodificar e recodificar cada mensagem"""
+    packer = thread_packer()
+    return b"".join([
+        packer.pack_map_header(2),
+        packer.pack("service"), packer.pack("batch"),
+        packer.pack("data"), packer.pack_map_header(1),
+        packer.pack("messages"), packer.pack_array_header(len(items)),
+        *items,
+    ])
+
+
+def publisher_thread(pull, routes):
+    """Única dona dos sockets PUB. Recebe [rota, tópico, payload] de qualquer
+    thread pelo inproc e envia no PUB da rota ("proxy", "mesh" ou "heartbeat").
+    Os PUBs vivem o processo todo, sem perder mensagens por slow joiner.
+
+    Na rota "coalesce" as mensagens ficam em buffer por tópico durante
+    PUBLISH_COALESCE_MS e saem no proxy como um único frame "batch", na ordem
+    em que chegaram (um lote com só uma mensagem sai no formato normal)"""
+    pending = {}  # tópico -> {"deadline": ts, "items": [payload codificado]}
+
+    def flush(topic):
+        items = pending.pop(topic)["items"]
+        frame = items[0] if len(items) == 1 else batch_frame(items)
+        routes["proxy"].send_multipart([topic, frame])
+
+    while True:
+        try:
+            timeout = None
+            if pending:
+                first = min(entry["deadline"] for entry in pending.values())
+                timeout = max(0, (first - time.time()) * 1000)
+            if pull.poll(timeout, zmq.POLLIN):
+                # Frames sem cópia: o payload segue para o PUB sem passar por bytes
+                route, topic, packed = pull.recv_multipart(copy=False)
+                route, topic = route.bytes, topic.bytes
+                if route == b"coalesce":
+                    entry = pending.setdefault(topic, {
+                        "deadline": time.time() + PUBLISH_COALESCE_MS / 1000,
+                        "items": [],
+                    })
+                    entry["items"].append(packed.buffer)
+                    if len(entry["items"]) >= COALESCE_MAX_BATCH:
+                        flush(topic)
+                else:
+                    sock = routes.get(route.decode())
+                    if sock is None:
+                        print(f"[PUB] Rota desconhecida: {route!r}")
+                        continue
+                    sock.send_multipart([topic, packed], copy=False)
+            now = time.time()
+            for topic in [t for t, entry in pending.items() if entry["deadline"] <= now]:
+                flush(topic)
+        except Exception as e:
+            print(f"[PUB] Erro ao publicar: {e}")
+
+
+def publish(topic, payload, route="proxy"):
+    """Enfileira uma publicação para o publicador (seguro em qualquer thread)"""
+    sock = getattr(publisher_local, "sock", None)
+    if sock is None:
+        sock = zmq.Context.instance().socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(PUBLISHER_ADDR)
+        publisher_local.sock = sock
+    body = pack(payload)
+    if topic == "replication":
+        # Só servidores assinam a replicação e todos descomprimem
+        body = compress_frame(body, SUPPORTED_COMPRESSION)
+    sock.send_multipart([route.encode(), topic.encode(), body], copy=False)
 
 
 # ---------- util de arquivos ----------
@@ -80,7 +236,9 @@ def ensure_file(path, default_content):
 def load_data():
     data = ensure_file(
         DATA_FILE,
-        {"users": [], "channels": [], "subscriptions": {}, "messages": []},
+        # Armazenamento novo já nasce com a caixa de entrada inicializada
+        {"users": [], "channels": [], "subscriptions": {}, "messages": [],
+         "delivered": {}, "delivered_initialized": True},
     )
     data.setdefault("users", [])
     data.setdefault("channels", [])
@@ -90,8 +248,13 @@ def load_data():
 
 
 def save_data(data):
-    with open(DATA_FILE, "w") as f:
+    # Escrita atômica: leitores concorrentes (replicação, snapshot) nunca
+    # veem o arquivo pela metade
+    tmp = DATA_FILE + ".tmp"
+    with open(tmp, "w") as f:
         json.dump(data, f, indent=4)
+    os.replace(tmp, DATA_FILE)
+    meta_refresh(data)
 
 
 def save_login(username):
@@ -102,33 +265,737 @@ def save_login(username):
         json.dump(logins, f, indent=4)
 
 
+# ---------- Metadados em memória (usuários, inscrições, cursores) ----------
+# Cópia pequena do que conversations/unread precisam, trocada inteira a cada
+# save_data (e ao reconstruir os índices): esses serviços não releem o
+# data.json com todas as mensagens
+data_meta = {"users": frozenset(), "subscriptions": {}, "read_cursors": {}}
+
+
+def meta_refresh(data):
+    global data_meta
+    data_meta = {
+        "users": frozenset(data.get("users", [])),
+        "subscriptions": {user: list(chs) for user, chs in data.get("subscriptions", {}).items()},
+        "read_cursors": {
+            user: {kind: dict(names) for kind, names in cursors.items()}
+            for user, cursors in data.get("read_cursors", {}).items()
+        },
+    }
+
+
+# ---------- Cache de histórico recente (ring buffer por canal) ----------
+HISTORY_RING_SIZE = 100  # Últimas mensagens guardadas por canal
+HISTORY_CACHE_BUDGET = 4 * 1024 * 1024  # Bytes (estimados em MsgPack) para todos os canais
+# Segundos relidos antes do cursor: cobre réplicas que recebem uma mensagem
+# depois de outras mais novas (atraso de replicação + diferença de relógio)
+CURSOR_LAG_WINDOW = float(os.getenv("CURSOR_LAG_WINDOW", "10"))
+CURSOR_ERROR = "since inválido (use o cursor devolvido pelo servidor)"
+history_cache = OrderedDict()  # canal -> ring; ordem = LRU (mais recente no fim)
+history_cache_bytes = 0
+history_stats = {"hits": 0, "misses": 0, "storage_reads": 0, "evictions": 0}
+history_lock = threading.Lock()
+
+
+def _history_push(entry, m):
+    """Acrescenta ao ring e devolve a variação de bytes (chamar com history_lock)"""
+    delta = 0
+    if len(entry["ring"]) == HISTORY_RING_SIZE:
+        delta -= entry["sizes"][0]  # Sai junto com a mensagem mais antiga
+    size = len(pack(m))
+    entry["ring"].append(m)
+    entry["sizes"].append(size)
+    entry["bytes"] += delta + size
+    return delta + size
+
+
+def _history_evict():
+    """Descarta canais frios até caber no orçamento (chamar com history_lock)"""
+    global history_cache_bytes
+    while history_cache_bytes > HISTORY_CACHE_BUDGET and len(history_cache) > 1:
+        ch, entry = history_cache.popitem(last=False)
+        history_cache_bytes -= entry["bytes"]
+        history_stats["evictions"] += 1
+
+
+def history_append(m):
+    """Mensagem nova gravada: entra no ring do canal, se ele estiver em cache"""
+    global history_cache_bytes
+    ch = m.get("channel")
+    if not ch or m.get("dst"):
+        return
+    with history_lock:
+        entry = history_cache.get(ch)
+        if entry is None:
+            return  # Canal frio: é carregado do disco na próxima leitura
+        history_cache_bytes += _history_push(entry, m)
+        entry["total"] += 1
+        _history_evict()
+
+
+def history_clear():
+    global history_cache_bytes
+    with history_lock:
+        history_cache.clear()
+        history_cache_bytes = 0
+
+
+def recent_history(ch, limit=None, since=None):
+    """Histórico do canal servido pelo ring (chamar com data_lock). Devolve
+    None se o pedido não cabe no ring: sem limite num canal com mais
+    mensagens que o ring, limite maior que o ring, ou janela do cursor
+    anterior ao início do ring"""
+    global history_cache_bytes
+    with history_lock:
+        entry = history_cache.get(ch)
+        if entry is not None:
+            history_cache.move_to_end(ch)
+            history_stats["hits"] += 1
+    if entry is None:
+        # Falta: monta o ring a partir do disco (única leitura de storage)
+        msgs = [m for m in load_data()["messages"] if m.get("channel") == ch and not m.get("dst")]
+        entry = {"ring": deque(maxlen=HISTORY_RING_SIZE), "sizes": deque(maxlen=HISTORY_RING_SIZE),
+                 "bytes": 0, "total": len(msgs)}
+        for m in msgs[-HISTORY_RING_SIZE:]:
+            _history_push(entry, m)
+        with history_lock:
+            history_stats["misses"] += 1
+            history_cache[ch] = entry
+            history_cache_bytes += entry["bytes"]
+            _history_evict()
+    complete = entry["total"] <= len(entry["ring"])
+    msgs = list(entry["ring"])
+    if since is not None:
+        # O que ficou fora do ring chegou antes do primeiro item dele, mas
+        # pode ter timestamp até CURSOR_LAG_WINDOW maior
+        start = since[0] - 2 * CURSOR_LAG_WINDOW
+        if not complete and (not msgs or (msgs[0].get("timestamp") or 0) > start):
+            return None
+        return messages_since(msgs, since, limit)
+    if not complete and (limit is None or limit > len(entry["ring"])):
+        return None
+    return msgs[-limit:] if limit else msgs
+
+
+def parse_cursor(value):
+    """Cursor vindo do pedido -> (timestamp, {id: timestamp} já entregues).
+    Aceita também um número (timestamp puro). None se ausente ou inválido"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value), {}
+    if isinstance(value, dict):
+        ts, seen = value.get("ts", 0), value.get("seen") or {}
+        if (isinstance(ts, (int, float)) and not isinstance(ts, bool) and isinstance(seen, dict)
+                and all(isinstance(k, str) and isinstance(v, (int, float)) for k, v in seen.items())):
+            return float(ts), seen
+    return None
+
+
+def messages_since(msgs, since, limit=None):
+    """Mensagens posteriores ao cursor, as mais antigas primeiro (com limit, o
+    cursor devolvido avança e o próximo pedido traz o restante). Relê a
+    janela CURSOR_LAG_WINDOW antes do cursor e pula o que ele já entregou"""
+    ts, seen = since
+    start = ts - CURSOR_LAG_WINDOW
+    newer = [
+        m for m in msgs
+        if (m.get("timestamp") or 0) > start and f"{message_identity(m):016x}" not in seen
+    ]
+    newer.sort(key=lambda m: m.get("timestamp") or 0)
+    return newer[:limit] if limit else newer
+
+
+def history_cursor(msgs, since=None):
+    """Cursor do próximo pedido incremental: timestamp da última mensagem e
+    as mensagens já entregues dentro da janela anterior a ele. Uma réplica
+    pode receber depois uma mensagem com timestamp menor que o de outra já
+    aplicada; se ela estiver dentro da janela, o próximo pedido ainda a traz
+    (em qualquer servidor), sem repetir as já entregues"""
+    ts, seen = since or (0.0, {})
+    ts = max([m.get("timestamp") or 0 for m in msgs] + [ts])
+    seen = dict(seen)
+    for m in msgs:
+        seen[f"{message_identity(m):016x}"] = m.get("timestamp") or 0
+    start = ts - CURSOR_LAG_WINDOW
+    return {"ts": ts, "seen": {k: v for k, v in seen.items() if v > start}}
+
+
+def sync_cursors_valid(cursors):
+    """{nome: cursor} do sync (cursor nulo = desde o início)"""
+    if cursors is None:
+        return True
+    return isinstance(cursors, dict) and all(
+        isinstance(name, str) and (c is None or parse_cursor(c) is not None) for name, c in cursors.items()
+    )
+
+
+def channel_history(ch, limit=None, since=None):
+    """Mensagens do canal: do ring quando possível, senão do disco"""
+    msgs = recent_history(ch, limit, since)
+    if msgs is None:
+        with history_lock:
+            history_stats["storage_reads"] += 1
+        msgs = [m for m in load_data()["messages"] if m.get("channel") == ch and not m.get("dst")]
+        if since is not None:
+            msgs = messages_since(msgs, since, limit)
+        elif limit:
+            msgs = msgs[-limit:]
+    return msgs
+
+
+def private_messages(data, user1, user2, since=None):
+    """Mensagens privadas entre os dois usuários (em qualquer direção)"""
+    msgs = [
+        m for m in data.get("messages", [])
+        if m.get("dst") and (
+            (m.get("src") == user1 and m.get("dst") == user2) or
+            (m.get("src") == user2 and m.get("dst") == user1)
+        )
+    ]
+    return msgs if since is None else messages_since(msgs, since)
+
+
+def history_cache_status():
+    with history_lock:
+        return {"channels": len(history_cache), "bytes": history_cache_bytes, **history_stats}
+
+
+def index_message(m):
+    """Atualiza os índices em memória com uma mensagem recém-gravada"""
+    digest_add(m)
+    history_append(m)
+    search_add(m)
+    unread_index(m)
+    conversation_index(m)
+    inbox_index(m)
+    if m.get("channel") and not m.get("dst"):
+        bump_version(f"history:{m.get('channel')}")
+
+
+def rebuild_indexes(data):
+    """Recalcula os índices em memória após trocar o estado inteiro (snapshot/partida)"""
+    meta_refresh(data)
+    rebuild_digest(data)
+    history_clear()
+    response_cache_clear()
+    search_restore(data)
+    unread_rebuild(data)
+    conversation_rebuild(data)
+    inbox_rebuild(data)
+
+
+# ---------- Cache de respostas codificadas ----------
+# users/channels/history guardam o corpo MsgPack pronto; só clock e timestamp
+# mudam entre chamadas e são escritos direto nos bytes (largura fixa)
+RESPONSE_CACHE_MAX = 256  # Entradas (LRU)
+RESPONSE_CACHE_BUDGET = 4 * 1024 * 1024  # Bytes de corpos guardados (LRU)
+# history com "since" não entra: o cursor muda a cada cliente e pedido
+CACHEABLE_SERVICES = {"users": (), "channels": (), "history": ("channel", "limit")}
+CLOCK_MARK = 0xFFFFFFFFFFFFFFFF  # Vira uint64 (0xcf + 8 bytes) no MsgPack
+CLOCK_MARK_BYTES = b"\xcf" + struct.pack(">Q", CLOCK_MARK)
+TS_MARK = -1.2345678901234567e308  # Vira float64 (0xcb + 8 bytes) no MsgPack
+TS_MARK_BYTES = b"\xcb" + struct.pack(">d", TS_MARK)
+response_cache = OrderedDict()  # chave -> (versão, corpo, pos. do clock, pos. do timestamp)
+response_cache_bytes = 0
+response_versions = {}  # "users" | "channels" | "history:<canal>" -> contador
+response_generation = 0  # Muda quando o estado inteiro é trocado
+response_stats = {"hits": 0, "misses": 0}
+response_lock = threading.Lock()
+
+
+def bump_version(name):
+    """Invalida as respostas em cache que dependem da coleção/canal"""
+    with response_lock:
+        response_versions[name] = response_versions.get(name, 0) + 1
+
+
+def response_cache_clear():
+    global response_generation, response_cache_bytes
+    with response_lock:
+        response_cache.clear()
+        response_cache_bytes = 0
+        response_versions.clear()
+        response_generation += 1
+
+
+def _response_key(request):
+    """(chave, nome da versão) do pedido, ou None se não for cacheável"""
+    service = request.get("service")
+    params = CACHEABLE_SERVICES.get(service)
+    # Réplica acrescenta staleness_ms, que muda a cada leitura
+    if params is None or SERVER_ROLE == "replica":
+        return None
+    payload = request.get("data", {})
+    if payload.get("since") is not None:
+        return None
+    key = (service,) + tuple(payload.get(p) for p in params)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    name = f"history:{payload.get('channel')}" if service == "history" else service
+    return key, name
+
+
+def response_version(request):
+    """Versão atual dos dados do pedido (ler antes de montar a resposta)"""
+    found = _response_key(request)
+    if found is None:
+        return None
+    with response_lock:
+        return response_generation, response_versions.get(found[1], 0)
+
+
+def _fill_reply(body, clock_pos, ts_pos, clock, ts):
+    """Corpo pronto com clock/timestamp escritos no lugar dos marcadores"""
+    out = bytearray(body)
+    struct.pack_into(">Q", out, clock_pos, clock)
+    struct.pack_into(">d", out, ts_pos, ts)
+    return bytes(out)
+
+
+def store_reply(request, version, resp):
+    """Guarda a resposta codificada com marcadores no lugar de clock/timestamp.
+    Devolve o corpo já pronto para este pedido (sem codificar de novo), ou
+    None se a resposta não foi guardada"""
+    global response_cache_bytes
+    found = _response_key(request)
+    if found is None or resp.get("data", {}).get("status") == "erro":
+        return None
+    template = dict(resp, data=dict(resp["data"], clock=CLOCK_MARK, timestamp=TS_MARK))
+    body = pack(template)
+    # Marcador repetido no conteúdo tornaria a posição ambígua; corpo maior
+    # que o orçamento expulsaria todo o resto: não guarda
+    if (body.count(CLOCK_MARK_BYTES) != 1 or body.count(TS_MARK_BYTES) != 1
+            or len(body) > RESPONSE_CACHE_BUDGET):
+        return None
+    entry = (version, body, body.index(CLOCK_MARK_BYTES) + 1, body.index(TS_MARK_BYTES) + 1)
+    with response_lock:
+        old = response_cache.pop(found[0], None)
+        if old is not None:
+            response_cache_bytes -= len(old[1])
+        response_cache[found[0]] = entry
+        response_cache_bytes += len(body)
+        while len(response_cache) > RESPONSE_CACHE_MAX or response_cache_bytes > RESPONSE_CACHE_BUDGET:
+            _, evicted = response_cache.popitem(last=False)
+            response_cache_bytes -= len(evicted[1])
+    return _fill_reply(body, entry[2], entry[3], resp["data"]["clock"], resp["data"]["timestamp"])
+
+
+def cached_reply(request):
+    """Resposta já codificada se os dados não mudaram desde que foi guardada
+    (chamar com data_lock); None se for preciso passar pelo handle_request"""
+    found = _response_key(request)
+    if found is None:
+        return None
+    key, name = found
+    with response_lock:
+        entry = response_cache.get(key)
+        if entry is None or entry[0] != (response_generation, response_versions.get(name, 0)):
+            response_stats["misses"] += 1
+            return None
+        response_cache.move_to_end(key)
+        response_stats["hits"] += 1
+    # Mesmo efeito no relógio que o handle_request teria
+    received_clock = request.get("data", {}).get("clock", 0)
+    if received_clock > 0:
+        update_clock(received_clock)
+    count_request()
+    _, body, clock_pos, ts_pos = entry
+    return _fill_reply(body, clock_pos, ts_pos, increment_clock(), time.time())
+
+
+def response_cache_status():
+    with response_lock:
+        return {"entries": len(response_cache), "bytes": response_cache_bytes, **response_stats}
+
+
+# ---------- Busca (índice invertido) ----------
+SEARCH_MAX_DOCS = 20000  # Mensagens mais recentes mantidas no índice
+SEARCH_MAX_TERMS = 64  # Termos distintos indexados por mensagem
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_PERSIST_INTERVAL = 30  # Segundos entre gravações de data/search.json
+TOKEN_RE = re.compile(r"\w{2,}")
+search_docs = OrderedDict()  # id -> mensagem, na ordem de chegada (as mais antigas saem primeiro)
+search_postings = {}  # termo -> {id: frequência do termo na mensagem}
+# Quantas mensagens o índice já viu e a última delas: confere o arquivo
+# persistido com data.json na partida
+search_seen = {"count": 0, "last": None}
+search_dirty = False
+search_lock = threading.Lock()
+
+
+def tokenize(text):
+    """Termos normalizados: minúsculas e sem acentos ("Ação" casa com "acao")"""
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    return TOKEN_RE.findall("".join(c for c in text if not unicodedata.combining(c)))
+
+
+def _search_drop(doc_id, m):
+    """Remove a mensagem das listas de postings (chamar com search_lock)"""
+    for term in set(tokenize(m.get("message"))):
+        postings = search_postings.get(term)
+        if postings is not None:
+            postings.pop(doc_id, None)
+            if not postings:
+                del search_postings[term]
+
+
+def search_add(m):
+    global search_dirty
+    doc_id = f"{message_identity(m):016x}"
+    terms = Counter(tokenize(m.get("message")))
+    with search_lock:
+        search_seen["count"] += 1
+        search_seen["last"] = doc_id
+        search_dirty = True
+        if doc_id in search_docs:
+            return
+        search_docs[doc_id] = m
+        for term, tf in terms.most_common(SEARCH_MAX_TERMS):
+            search_postings.setdefault(term, {})[doc_id] = tf
+        while len(search_docs) > SEARCH_MAX_DOCS:
+            _search_drop(*search_docs.popitem(last=False))
+
+
+def search_rebuild(data):
+    messages = data.get("messages", [])
+    with search_lock:
+        search_docs.clear()
+        search_postings.clear()
+        search_seen.update(count=len(messages) - min(len(messages), SEARCH_MAX_DOCS), last=None)
+    for m in messages[-SEARCH_MAX_DOCS:]:
+        search_add(m)
+
+
+def search_restore(data):
+    """Usa o índice persistido se ele viu exatamente as mensagens de data.json;
+    senão reconstrói a partir delas"""
+    global search_dirty
+    messages = data.get("messages", [])
+    stamp = {"count": len(messages), "last": f"{message_identity(messages[-1]):016x}" if messages else None}
+    try:
+        with open(SEARCH_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+    if saved and saved.get("seen") == stamp:
+        with search_lock:
+            search_docs.clear()
+            search_docs.update((doc_id, m) for doc_id, m in saved["docs"])
+            search_postings.clear()
+            search_postings.update(saved["postings"])
+            search_seen.update(stamp)
+            search_dirty = False
+        print(f"[SEARCH] Índice carregado de {SEARCH_FILE} ({len(search_docs)} mensagens)")
+        return
+    search_rebuild(data)
+    print(f"[SEARCH] Índice reconstruído ({len(search_docs)} mensagens)")
+
+
+def search_save():
+    """Grava o índice junto dos dados (só se mudou desde a última gravação).
+    Sob o lock só copia as estruturas (rasas: as mensagens não mudam depois
+    de indexadas); a serialização fica fora dele e não trava buscas/gravações"""
+    global search_dirty
+    with search_lock:
+        if not search_dirty:
+            return
+        snapshot = {
+            "seen": dict(search_seen),
+            "docs": list(search_docs.items()),
+            "postings": {term: dict(postings) for term, postings in search_postings.items()},
+        }
+        search_dirty = False
+    blob = json.dumps(snapshot)
+    tmp = SEARCH_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(blob)
+    os.replace(tmp, SEARCH_FILE)
+
+
+def _search_visible(m, channel, user, as_user):
+    """Filtros da busca; mensagens privadas só para quem participa da conversa"""
+    if m.get("dst"):
+        return (
+            channel is None and as_user is not None and as_user in (m.get("src"), m.get("dst"))
+            and (user is None or m.get("src") == user)
+        )
+    return (channel is None or m.get("channel") == channel) and (user is None or m.get("user") == user)
+
+
+def search_messages(query, channel=None, user=None, as_user=None, page=1, page_size=SEARCH_PAGE_SIZE):
+    """(página de resultados, total) ranqueados por TF-IDF; empate favorece a
+    mensagem mais recente"""
+    scores = {}
+    with search_lock:
+        total_docs = len(search_docs)
+        for term in set(tokenize(query)):
+            postings = search_postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + total_docs / len(postings))
+            for doc_id, tf in postings.items():
+                if _search_visible(search_docs[doc_id], channel, user, as_user):
+                    scores[doc_id] = scores.get(doc_id, 0) + (1 + math.log(tf)) * idf
+        ranked = sorted(scores, key=lambda d: (scores[d], search_docs[d].get("timestamp") or 0), reverse=True)
+        start = (page - 1) * page_size
+        results = [
+            dict(search_docs[doc_id], id=doc_id, score=round(scores[doc_id], 3))
+            for doc_id in ranked[start:start + page_size]
+        ]
+    return results, len(ranked)
+
+
+def search_status():
+    with search_lock:
+        return {"docs": len(search_docs), "terms": len(search_postings)}
+
+
+# ---------- Cursores de leitura e não lidas ----------
+# Cursor = timestamp da última mensagem lida (o mesmo em todas as réplicas),
+# gravado em data["read_cursors"][usuário]["channels" | "peers"][nome].
+# As contagens saem de uma linha do tempo por conversa mantida a cada
+# mensagem gravada: não lidas = mensagens com timestamp após o cursor
+conversation_times = {}  # message_key -> timestamps ordenados
+own_last = {}  # usuário -> {message_key: timestamp da última mensagem enviada por ele}
+unread_lock = threading.Lock()
+
+
+def dm_key(user1, user2):
+    """Mesma chave de message_key para a conversa privada entre os dois"""
+    return "dm:" + "|".join(sorted([str(user1), str(user2)]))
+
+
+def unread_index(m):
+    key, ts = message_key(m), float(m.get("timestamp") or 0)
+    author = m.get("src") or m.get("user")
+    with unread_lock:
+        bisect.insort(conversation_times.setdefault(key, []), ts)
+        # Quem envia já leu a conversa até a própria mensagem
+        last = own_last.setdefault(author, {})
+        last[key] = max(last.get(key, 0), ts)
+
+
+def unread_rebuild(data):
+    with unread_lock:
+        conversation_times.clear()
+        own_last.clear()
+    for m in data.get("messages", []):
+        unread_index(m)
+
+
+def latest_time(key):
+    with unread_lock:
+        times = conversation_times.get(key)
+        return times[-1] if times else 0
+
+
+def read_cursor(data, user, kind, name, key):
+    """Cursor efetivo: o marcado pelo usuário ou a última mensagem que ele enviou"""
+    marked = data.get("read_cursors", {}).get(user, {}).get(kind, {}).get(name, 0)
+    with unread_lock:
+        return max(marked, own_last.get(user, {}).get(key, 0))
+
+
+def unread_count(data, user, kind, name, key):
+    cursor = read_cursor(data, user, kind, name, key)
+    with unread_lock:
+        times = conversation_times.get(key, [])
+        return len(times) - bisect.bisect_right(times, cursor)
+
+
+def set_read_cursor(data, user, kind, name, cursor):
+    """Avança o cursor (nunca recua: réplicas convergem pelo maior). True se mudou"""
+    cursors = data.setdefault("read_cursors", {}).setdefault(user, {}).setdefault(kind, {})
+    if cursor <= cursors.get(name, 0):
+        return False
+    cursors[name] = cursor
+    return True
+
+
+# ---------- Conversas privadas (resumo por usuário) ----------
+# usuário -> {peer: {"last_message", "timestamp", "count"}}: a caixa de
+# entrada sai daqui sem varrer mensagens (O(número de conversas))
+conversation_summaries = {}
+conversation_lock = threading.Lock()
+
+
+def conversation_index(m):
+    if not m.get("dst"):
+        return
+    src, dst = m.get("src"), m.get("dst")
+    ts = float(m.get("timestamp") or 0)
+    with conversation_lock:
+        for user, peer in ((src, dst), (dst, src)):
+            summary = conversation_summaries.setdefault(user, {}).setdefault(
+                peer, {"last_message": None, "timestamp": 0, "count": 0}
+            )
+            summary["count"] += 1
+            # Réplicas podem receber fora de ordem: vale a de maior timestamp
+            if ts >= summary["timestamp"]:
+                summary["last_message"] = m
+                summary["timestamp"] = ts
+
+
+def conversation_rebuild(data):
+    with conversation_lock:
+        conversation_summaries.clear()
+    for m in data.get("messages", []):
+        conversation_index(m)
+
+
+def conversation_peers(user):
+    with conversation_lock:
+        return sorted(conversation_summaries.get(user, {}))
+
+
+def conversation_list(user):
+    """Conversas do usuário, a mais recente primeiro"""
+    with conversation_lock:
+        summaries = [dict(summary, peer=peer) for peer, summary in conversation_summaries.get(user, {}).items()]
+    return sorted(summaries, key=lambda c: c["timestamp"], reverse=True)
+
+
+# ---------- Caixa de entrada offline ----------
+# Pub/Sub descarta mensagens privadas de quem não está conectado. Cada usuário
+# tem uma fila limitada com as últimas mensagens privadas recebidas e um
+# cursor de entrega (data["delivered"][usuário], timestamp): o login entrega o
+# que passou do cursor e o avança; o logout avança o cursor até o que já foi
+# visto ao vivo. O cursor é replicado, então o próximo login pode ser em
+# qualquer réplica
+INBOX_MAX = 100  # Mensagens por usuário (as mais antigas são descartadas)
+inboxes = {}  # usuário -> deque de mensagens privadas recebidas, ordenada por timestamp
+inbox_lock = threading.Lock()
+
+
+def inbox_index(m):
+    if not m.get("dst"):
+        return
+    with inbox_lock:
+        inbox = inboxes.setdefault(m.get("dst"), deque(maxlen=INBOX_MAX))
+        inbox.append(m)
+        # Réplica pode receber fora de ordem: reordena só a cauda
+        i = len(inbox) - 1
+        while i > 0 and (inbox[i - 1].get("timestamp") or 0) > (m.get("timestamp") or 0):
+            inbox[i - 1], inbox[i] = inbox[i], inbox[i - 1]
+            i -= 1
+
+
+def inbox_rebuild(data):
+    with inbox_lock:
+        inboxes.clear()
+    for m in data.get("messages", []):
+        inbox_index(m)
+    if not data.get("delivered_initialized"):
+        # Migração única de um data.json anterior à caixa de entrada: as
+        # mensagens privadas que já existiam não voltam como "recebidas
+        # enquanto offline". A marca gravada junto impede que uma partida
+        # posterior (com mensagens ainda não entregues) repita a migração
+        delivered = data.setdefault("delivered", {})
+        for user in list(inboxes):
+            if user not in delivered and inbox_latest(user):
+                delivered[user] = inbox_latest(user)
+        data["delivered_initialized"] = True
+        save_data(data)
+        print(f"[INBOX] Cursor de entrega inicializado para {len(delivered)} usuários")
+    for user, cursor in data.get("delivered", {}).items():
+        inbox_ack(data, user, cursor)
+
+
+def inbox_pending(data, user):
+    """Mensagens ainda não entregues ao usuário (O(mensagens perdidas))"""
+    delivered = data.get("delivered", {}).get(user, 0)
+    with inbox_lock:
+        inbox = inboxes.get(user, ())
+        pending = []
+        for m in reversed(inbox):
+            if (m.get("timestamp") or 0) <= delivered:
+                break
+            pending.append(m)
+    return pending[::-1]
+
+
+def inbox_ack(data, user, cursor):
+    """Avança o cursor de entrega e descarta da fila o que já foi entregue.
+    True se o cursor mudou"""
+    with inbox_lock:
+        inbox = inboxes.get(user)
+        while inbox and (inbox[0].get("timestamp") or 0) <= cursor:
+            inbox.popleft()
+    delivered = data.setdefault("delivered", {})
+    if cursor <= delivered.get(user, 0):
+        return False
+    delivered[user] = cursor
+    return True
+
+
+def inbox_latest(user):
+    with inbox_lock:
+        inbox = inboxes.get(user)
+        return (inbox[-1].get("timestamp") or 0) if inbox else 0
+
+
 # ---------- Comunicação com Referência ----------
+REFERENCE_TIMEOUT = 2000  # ms por tentativa
+REFERENCE_RETRIES = 3
+
+
+class ReferenceClient:
+    """Conexão persistente com o serviço de referência (padrão Lazy Pirate)
+
+    Um único contexto e socket REQ compartilhados por todas as threads. Se a
+    resposta não chega no timeout o REQ fica travado, então é descartado e
+    recriado antes da próxima tentativa.
+    """
+
+    def __init__(self, endpoint, timeout=REFERENCE_TIMEOUT, retries=REFERENCE_RETRIES):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.ctx = zmq.Context.instance()
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = self.ctx.socket(zmq.REQ)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(self.endpoint)
+
+    def _reset(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def request(self, service, data):
+        with self.lock:
+            data["timestamp"] = time.time()
+            data["clock"] = increment_clock()
+            packed = pack({"service": service, "data": data})
+            for attempt in range(1, self.retries + 1):
+                if self.sock is None:
+                    self._connect()
+                send_packed(self.sock, packed)
+                if self.sock.poll(self.timeout, zmq.POLLIN):
+                    resp = recv_msgpack(self.sock)
+                    received_clock = resp.get("data", {}).get("clock", 0)
+                    if received_clock > 0:
+                        update_clock(received_clock)
+                    return resp
+                print(f"[REFERENCE] Sem resposta para '{service}' (tentativa {attempt}/{self.retries}), reconectando")
+                self._reset()
+            raise TimeoutError(f"serviço de referência não respondeu a '{service}'")
+
+
+reference_client = ReferenceClient(f"tcp://{REFERENCE_HOST}:{REFERENCE_PORT}")
+
+
 def get_rank_from_reference():
     global server_rank
     try:
-        ctx = zmq.Context()
-        req = ctx.socket(zmq.REQ)
-        req.setsockopt(zmq.LINGER, 0)
-        req.connect(f"tcp://{REFERENCE_HOST}:{REFERENCE_PORT}")
-        
-        clock = increment_clock()
-        msg = {
-            "service": "rank",
-            "data": {
-                "user": server_name,
-                "timestamp": time.time(),
-                "clock": clock,
-            },
-        }
-        send_msgpack(req, msg)
-        resp = recv_msgpack(req)
-        req.close()
-        ctx.term()
-        
+        resp = reference_client.request("rank", {"user": server_name})
         if resp.get("service") == "rank":
             server_rank = resp.get("data", {}).get("rank")
-            received_clock = resp.get("data", {}).get("clock", 0)
-            update_clock(received_clock)
             print(f"[SERVER] Rank recebido: {server_rank}")
             return server_rank
     except Exception as e:
@@ -138,115 +1005,410 @@ def get_rank_from_reference():
 
 def send_heartbeat():
     try:
-        ctx = zmq.Context()
-        req = ctx.socket(zmq.REQ)
-        req.setsockopt(zmq.LINGER, 0)
-        req.setsockopt(zmq.RCVTIMEO, 2000)
-        req.connect(f"tcp://{REFERENCE_HOST}:{REFERENCE_PORT}")
-        
-        clock = increment_clock()
-        msg = {
-            "service": "heartbeat",
-            "data": {
-                "user": server_name,
-                "timestamp": time.time(),
-                "clock": clock,
-            },
-        }
-        send_msgpack(req, msg)
-        try:
-            resp = recv_msgpack(req)
-            received_clock = resp.get("data", {}).get("clock", 0)
-            update_clock(received_clock)
-        except:
-            pass
-        req.close()
-        ctx.term()
+        reference_client.request("heartbeat", {"user": server_name})
     except Exception as e:
         print(f"[SERVER] Erro no heartbeat: {e}")
 
 
 def get_server_list():
     try:
-        ctx = zmq.Context()
-        req = ctx.socket(zmq.REQ)
-        req.setsockopt(zmq.LINGER, 0)
-        req.setsockopt(zmq.RCVTIMEO, 2000)
-        req.connect(f"tcp://{REFERENCE_HOST}:{REFERENCE_PORT}")
-        
-        clock = increment_clock()
-        msg = {
-            "service": "list",
-            "data": {
-                "timestamp": time.time(),
-                "clock": clock,
-            },
-        }
-        send_msgpack(req, msg)
-        resp = recv_msgpack(req)
-        req.close()
-        ctx.term()
-        
-        received_clock = resp.get("data", {}).get("clock", 0)
-        update_clock(received_clock)
-        
+        resp = reference_client.request("list", {})
         if resp.get("service") == "list":
-            return resp.get("data", {}).get("list", [])
+            return resp.get("data", {}).get("list") or []
     except Exception as e:
         print(f"[SERVER] Erro ao obter lista de servidores: {e}")
     return []
 
 
+# ---------- Conexões com peers (cache + circuit breaker) ----------
+PEER_PORT = 5555
+PEER_TIMEOUT = 2000  # ms
+BREAKER_THRESHOLD = 2  # Falhas consecutivas para abrir o circuito
+BREAKER_BASE_BACKOFF = 1.0  # Segundos com o circuito aberto na 1ª vez
+BREAKER_MAX_BACKOFF = 30.0
+
+
+class PeerUnavailable(Exception):
+    """Circuito aberto: o peer falhou há pouco e a chamada nem é tentada"""
+
+
+class PeerConnection:
+    """REQ reaproveitado para um peer, com estado de saúde e circuit breaker
+
+    closed    -> chamadas normais
+    open      -> falha imediata até o backoff expirar
+    half_open -> uma chamada de prova; sucesso fecha, falha reabre com backoff dobrado
+    """
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.sock = None
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.backoff = BREAKER_BASE_BACKOFF
+        self.open_until = 0
+        self.last_ok = None
+
+    def _reset(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def _on_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.backoff = BREAKER_BASE_BACKOFF
+        self.last_ok = time.time()
+
+    def _on_failure(self):
+        self._reset()
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= BREAKER_THRESHOLD:
+            if self.state == "half_open":
+                self.backoff = min(self.backoff * 2, BREAKER_MAX_BACKOFF)
+            self.state = "open"
+            self.open_until = time.time() + self.backoff
+            print(f"[PEER] Circuito aberto para {self.peer} por {self.backoff:.0f}s")
+
+    def _send(self, service, data):
+        """Envia a requisição (chamar com self.lock); falha se o circuito está aberto"""
+        if self.state == "open":
+            if time.time() < self.open_until:
+                raise PeerUnavailable(f"{self.peer} indisponível (circuito aberto)")
+            self.state = "half_open"
+        if self.sock is None:
+            self.sock = zmq.Context.instance().socket(zmq.REQ)
+            self.sock.setsockopt(zmq.LINGER, 0)
+            self.sock.connect(f"tcp://{self.peer}:{PEER_PORT}")
+        data = dict(data, timestamp=time.time(), clock=increment_clock())
+        send_msgpack(self.sock, {"service": service, "data": data, "compression": SUPPORTED_COMPRESSION})
+
+    def request(self, service, data, timeout=PEER_TIMEOUT):
+        with self.lock:
+            self._send(service, data)
+            if not self.sock.poll(timeout, zmq.POLLIN):
+                self._on_failure()
+                raise TimeoutError(f"{self.peer} não respondeu a '{service}' em {timeout}ms")
+            resp = recv_msgpack(self.sock)
+            self._on_success()
+
+        received_clock = resp.get("data", {}).get("clock", 0)
+        if received_clock > 0:
+            update_clock(received_clock)
+        return resp
+
+    def status(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in": round(max(0, self.open_until - time.time()), 1) if self.state == "open" else 0,
+                "last_ok": self.last_ok,
+            }
+
+
+peer_connections = {}  # peer -> PeerConnection
+peer_connections_lock = threading.Lock()
+
+
+def get_peer_connection(peer):
+    with peer_connections_lock:
+        conn = peer_connections.get(peer)
+        if conn is None:
+            conn = peer_connections[peer] = PeerConnection(peer)
+        return conn
+
+
+def request_many(peers, service, data, timeout=PEER_TIMEOUT, stop_on_first=False, timings=None):
+    """Envia a mesma requisição a vários peers de uma vez e coleta as respostas
+    em um único Poller com um prazo total (em vez de um timeout por peer).
+    stop_on_first pode ser uma função: para na primeira resposta que a
+    satisfaça. Se timings for um dict, recebe peer -> (enviado_em, recebido_em)"""
+    # Ordem fixa de aquisição dos locks evita deadlock entre threads
+    conns = sorted({get_peer_connection(p) for p in peers}, key=lambda c: c.peer)
+    for conn in conns:
+        conn.lock.acquire()
+    try:
+        poller = zmq.Poller()
+        pending = {}
+        sent_at = {}
+        for conn in conns:
+            try:
+                conn._send(service, data)
+            except PeerUnavailable:
+                continue
+            sent_at[conn.peer] = time.time()
+            poller.register(conn.sock, zmq.POLLIN)
+            pending[conn.sock] = conn
+
+        replies = {}
+        stopped = False
+        deadline = time.time() + timeout / 1000
+        while pending and not stopped:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for sock, _ in poller.poll(remaining * 1000):
+                conn = pending.pop(sock)
+                poller.unregister(sock)
+                resp = recv_msgpack(sock)
+                if timings is not None:
+                    timings[conn.peer] = (sent_at[conn.peer], time.time())
+                conn._on_success()
+                received_clock = resp.get("data", {}).get("clock", 0)
+                if received_clock > 0:
+                    update_clock(received_clock)
+                replies[conn.peer] = resp
+                if stop_on_first is True or (callable(stop_on_first) and stop_on_first(resp)):
+                    stopped = True
+
+        for conn in pending.values():
+            if stopped:
+                conn._reset()  # Resposta dispensada: só descarta o REQ pendente
+            else:
+                conn._on_failure()
+        return replies
+    finally:
+        for conn in conns:
+            conn.lock.release()
+
+
+def peer_health():
+    with peer_connections_lock:
+        conns = list(peer_connections.values())
+    return {conn.peer: conn.status() for conn in conns}
+
+
+# ---------- Detector de falhas phi-accrual ----------
+HEARTBEAT_PORT = 5561
+HEARTBEAT_INTERVAL = int(os.getenv("PEER_HEARTBEAT_MS", "500")) / 1000  # s entre heartbeats
+PHI_THRESHOLD = float(os.getenv("PHI_THRESHOLD", "8"))  # Suspeita a partir deste phi
+PHI_WINDOW = 100  # Intervalos guardados por peer
+PHI_MIN_STD = 0.1  # Desvio mínimo (s): evita suspeitas com intervalos muito regulares
+
+
+class PhiAccrualDetector:
+    """Detector phi-accrual (Hayashibara et al.): em vez de um timeout fixo,
+    mede quão improvável é o silêncio atual dado o histórico de intervalos
+    entre heartbeats. phi = 8 equivale a ~1 chance em 10^8 de ser atraso."""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.intervals = deque(maxlen=PHI_WINDOW)
+        self.last = None
+        self.suspected = False
+
+    def heartbeat(self, now):
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        else:
+            # Primeiro heartbeat: assume o intervalo nominal até ter amostras
+            self.intervals.append(HEARTBEAT_INTERVAL)
+        self.last = now
+        self.suspected = False
+
+    def phi(self, now):
+        if self.last is None:
+            return 0.0
+        mean = sum(self.intervals) / len(self.intervals)
+        var = sum((x - mean) ** 2 for x in self.intervals) / len(self.intervals)
+        std = max(math.sqrt(var), PHI_MIN_STD)
+        # Aproximação logística da CDF normal (a mesma usada pelo Akka)
+        y = (now - self.last - mean) / std
+        e = math.exp(min(-y * (1.5976 + 0.070566 * y * y), 700))
+        if now - self.last > mean:
+            return -math.log10(e / (1.0 + e)) if e > 0 else float("inf")
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def status(self, now):
+        return {
+            "phi": round(min(self.phi(now), 1e6), 2),
+            "last_seen": round(now - self.last, 3) if self.last else None,
+            "suspected": self.suspected,
+        }
+
+
+detectors = {}  # peer -> PhiAccrualDetector
+detectors_lock = threading.Lock()
+peer_roles = {}  # peer -> papel anunciado no heartbeat (primary/replica)
+
+
+def is_suspected(peer):
+    with detectors_lock:
+        det = detectors.get(peer)
+        return bool(det and det.suspected)
+
+
+def detector_status():
+    now = time.time()
+    with detectors_lock:
+        return {peer: det.status(now) for peer, det in detectors.items()}
+
+
+def check_coordinator_liveness(now):
+    """Se o coordenador ficou suspeito, revoga o lease localmente: a
+    lease_thread acorda e dispara a eleição sem esperar o lease expirar"""
+    global coordinator
+    with coordinator_lock:
+        holder = lease["coordinator"]
+    if not holder or holder == server_name:
+        return
+    with detectors_lock:
+        det = detectors.get(holder)
+        if not det or det.suspected:
+            return
+        phi = det.phi(now)
+        if phi < PHI_THRESHOLD:
+            return
+        det.suspected = True
+    print(f"[DETECTOR] Coordenador {holder} suspeito (phi={phi:.1f}), revogando lease")
+    with coordinator_lock:
+        if lease["coordinator"] == holder:
+            lease["coordinator"] = None
+            lease["expires"] = 0.0
+            coordinator = None
+    lease_changed.set()
+
+
+def failure_detector_thread():
+    """Heartbeats diretos entre servidores (PUB/SUB na porta HEARTBEAT_PORT,
+    sem passar pelo proxy) alimentando um detector phi-accrual por peer.
+    O PUB da porta fica com o publicador único (rota "heartbeat")"""
+    ctx = zmq.Context()
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt_string(zmq.SUBSCRIBE, "heartbeat")
+    poller = zmq.Poller()
+    poller.register(sub, zmq.POLLIN)
+    print(f"[DETECTOR] Heartbeats em tcp://*:{HEARTBEAT_PORT} (phi > {PHI_THRESHOLD} = suspeito)")
+
+    connected = set()
+    last_refresh = 0
+    next_beat = time.time()
+    while True:
+        try:
+            now = time.time()
+            if now - last_refresh > PEER_LIST_TTL:
+                connected = refresh_mesh_peers(sub, connected, port=HEARTBEAT_PORT, tag="DETECTOR")
+                last_refresh = now
+            if now >= next_beat:
+                # Heartbeat não mexe no relógio lógico: não é um evento da aplicação.
+                # Leva a posição de replicação para as réplicas medirem o atraso
+                with replication_lock:
+                    epoch, seq = replication_epoch, replication_seq
+                msg = {"service": "heartbeat", "data": {
+                    "server": server_name, "role": SERVER_ROLE, "epoch": epoch, "seq": seq, "timestamp": now,
+                }}
+                publish("heartbeat", msg, route="heartbeat")
+                next_beat = now + HEARTBEAT_INTERVAL
+            timeout = max(0, min(next_beat - time.time(), HEARTBEAT_INTERVAL / 5))
+            for _ in poller.poll(timeout * 1000):
+                frames = sub.recv_multipart(copy=False)
+                beat = unpack(frames[-1]).get("data", {})
+                peer = beat.get("server")
+                if not peer or peer == server_name:
+                    continue
+                with detectors_lock:
+                    det = detectors.get(peer)
+                    if det is None:
+                        det = detectors[peer] = PhiAccrualDetector(peer)
+                    det.heartbeat(time.time())
+                    peer_roles[peer] = beat.get("role", "primary")
+                note_peer_position(peer, beat.get("epoch"), beat.get("seq"))
+            check_coordinator_liveness(time.time())
+        except Exception as e:
+            print(f"[DETECTOR] Erro: {e}")
+            time.sleep(HEARTBEAT_INTERVAL)
+
+
 # ---------- Sincronização de Relógio Físico (Berkeley) ----------
+BERKELEY_INTERVAL = 30  # Segundos entre rodadas conduzidas pelo coordenador
+BERKELEY_MAX_RTT = 0.5  # s: amostras com ida e volta maior que isso são imprecisas demais
+BERKELEY_MAX_SKEW = 1.0  # s: offsets tão longe da mediana ficam fora da média
+clock_offset = 0.0  # Correção local aplicada ao relógio físico (s)
+last_clock_time = 0.0  # Último valor entregue por physical_time (monotônico)
+physical_clock_lock = threading.Lock()
+last_berkeley = {}  # Resultado da última rodada (coordenador)
+
+
+def physical_time():
+    """Relógio físico do servidor já corrigido pelo Berkeley. Nunca volta
+    atrás: uma correção negativa só segura o relógio até o tempo alcançá-lo"""
+    global last_clock_time
+    with physical_clock_lock:
+        now = max(time.time() + clock_offset, last_clock_time)
+        last_clock_time = now
+        return now
+
+
+def adjust_physical_clock(delta):
+    global clock_offset
+    with physical_clock_lock:
+        clock_offset += delta
+        offset = clock_offset
+    print(f"[BERKELEY] Relógio ajustado em {delta * 1000:+.1f}ms (offset total {offset * 1000:+.1f}ms)")
+
+
 def sync_physical_clock():
-    global coordinator
+    """Rodada de Berkeley conduzida pelo coordenador: consulta o relógio de
+    todos os servidores de uma vez, compensa metade do RTT, descarta outliers,
+    tira a média e envia a cada um a correção que lhe cabe"""
     with coordinator_lock:
-        coord = coordinator
-    
-    if not coord or coord == server_name:
-        # Sou o coordenador ou não há coordenador
+        if lease["coordinator"] != server_name:
+            return  # Só o coordenador conduz a rodada
+        token = lease["token"]
+
+    peers = [p for p in get_peers() if not is_suspected(p)]
+    if not peers:
         return
-    
-    try:
-        # Conecta ao coordenador (usando hostname do Docker)
-        # O coordenador é o nome do servidor (ex: server_1)
-        ctx = zmq.Context()
-        req = ctx.socket(zmq.REQ)
-        req.setsockopt(zmq.LINGER, 0)
-        req.setsockopt(zmq.RCVTIMEO, 2000)
-        # No Docker, os hostnames são server_1, server_2, server_3
-        req.connect(f"tcp://{coord}:5555")
-        
-        clock = increment_clock()
-        msg = {
-            "service": "clock",
-            "data": {
-                "timestamp": time.time(),
-                "clock": clock,
-            },
-        }
-        send_msgpack(req, msg)
-        resp = recv_msgpack(req)
-        req.close()
-        ctx.term()
-        
-        received_clock = resp.get("data", {}).get("clock", 0)
-        update_clock(received_clock)
-        
-        if resp.get("service") == "clock":
-            coord_time = resp.get("data", {}).get("time")
-            if coord_time:
-                # Ajusta relógio físico (simulado)
-                diff = coord_time - time.time()
-                print(f"[SERVER] Sincronização: diferença = {diff:.3f}s")
-    except Exception as e:
-        print(f"[SERVER] Erro na sincronização com coordenador: {e}")
-        # Tenta eleição
-        start_election()
+    timings = {}
+    replies = request_many(peers, "clock", {}, timeout=PEER_TIMEOUT, timings=timings)
+
+    # Offset de cada relógio em relação ao meu; o remoto leu a hora por volta
+    # do meio da ida e volta
+    offsets = {server_name: 0.0}
+    rejected = {}
+    for peer, resp in replies.items():
+        remote = resp.get("data", {}).get("time")
+        if remote is None or peer not in timings:
+            continue
+        sent, received = timings[peer]
+        rtt = received - sent
+        offset = remote + rtt / 2 - (received + clock_offset)
+        if rtt > BERKELEY_MAX_RTT:
+            rejected[peer] = offset
+        else:
+            offsets[peer] = offset
+
+    ordered = sorted(offsets.values())
+    median = ordered[len(ordered) // 2]
+    good = {p: o for p, o in offsets.items() if abs(o - median) <= BERKELEY_MAX_SKEW}
+    rejected.update({p: o for p, o in offsets.items() if p not in good})
+    average = sum(good.values()) / len(good)
+
+    # Todos (inclusive outliers) recebem a correção até a média do grupo
+    adjustments = {p: average - o for p, o in {**good, **rejected}.items()}
+    remote_adjustments = {p: a for p, a in adjustments.items() if p != server_name}
+    if remote_adjustments:
+        request_many(list(remote_adjustments), "clock_adjust",
+                     {"adjustments": remote_adjustments, "token": token})
+    adjust_physical_clock(adjustments[server_name])
+
+    last_berkeley.update({
+        "time": physical_time(),
+        "participants": sorted(good),
+        "outliers": sorted(rejected),
+        "adjustments_ms": {p: round(a * 1000, 2) for p, a in adjustments.items()},
+    })
+    print(f"[BERKELEY] Rodada com {len(good)} relógios ({len(rejected)} descartados), "
+          f"correção média {average * 1000:+.1f}ms")
 
 
 def start_election():
     global coordinator, server_rank
+    if SERVER_ROLE == "replica":
+        # Réplica somente leitura nunca vira coordenador (nem writer)
+        return
     servers = get_server_list()
     if not servers:
         print("[SERVER] Nenhum servidor na lista, pulando eleição")
@@ -259,140 +1421,464 @@ def start_election():
     
     # Filtra servidores com rank menor (maior prioridade)
     # Rank menor = número menor = maior prioridade
-    candidates = [s for s in servers if s.get("rank", 999) < server_rank]
+    candidates = [
+        s for s in servers
+        if s.get("rank", 999) < server_rank and s.get("name") != server_name
+    ]
+    # Réplicas não disputam a eleição
+    with detectors_lock:
+        candidates = [s for s in candidates if peer_roles.get(s.get("name")) != "replica"]
+    # Peers que o detector já considera mortos não seguram a eleição até o timeout
+    suspected = [s.get("name") for s in candidates if is_suspected(s.get("name"))]
+    if suspected:
+        print(f"[DETECTOR] Ignorando candidatos suspeitos: {', '.join(suspected)}")
+        candidates = [s for s in candidates if s.get("name") not in suspected]
     
+    with coordinator_lock:
+        holder = lease["coordinator"]
+        valid = lease["expires"] > time.time()
+        known_token = lease["max_token"]
+    if valid and holder == server_name:
+        # Já sou o coordenador: basta renovar (vira novo mandato se alguém
+        # tiver mostrado um token maior)
+        announce_coordinator(renewal=True)
+        return
+    if valid:
+        # Lease em vigor: o coordenador atual só é trocado quando parar de renovar
+        print(f"[LEASE] Lease de {holder} ainda válido, eleição desnecessária")
+        return
+
     print(f"[SERVER] Iniciando eleição. Meu rank: {server_rank}, Candidatos com rank menor: {len(candidates)}")
+    start = time.time()
     
-    if not candidates:
-        # Sou o coordenador (tenho o menor rank ou sou o único)
-        with coordinator_lock:
-            coordinator = server_name
-        announce_coordinator()
-        print(f"[SERVER] Eleito como coordenador (rank {server_rank})")
-    else:
-        # Envia requisição de eleição para servidores com rank menor
+    replies = {}
+    if candidates:
+        # Envia a requisição a todos os candidatos de uma vez: basta um
+        # responder para sabermos que alguém de maior prioridade assume.
+        # O token enviado garante que o vencedor abra um mandato mais novo
+        names = [srv.get("name") for srv in candidates]
         print(f"[SERVER] Enviando requisição de eleição para {len(candidates)} servidores")
-        for srv in candidates:
-            try:
-                srv_name = srv.get('name')
-                srv_rank = srv.get('rank', 999)
-                print(f"[SERVER] Tentando conectar com {srv_name} (rank {srv_rank})")
-                ctx = zmq.Context()
-                req = ctx.socket(zmq.REQ)
-                req.setsockopt(zmq.LINGER, 0)
-                req.setsockopt(zmq.RCVTIMEO, 2000)
-                req.connect(f"tcp://{srv_name}:5555")
-                
-                clock = increment_clock()
-                msg = {
-                    "service": "election",
-                    "data": {
-                        "timestamp": time.time(),
-                        "clock": clock,
-                    },
-                }
-                send_msgpack(req, msg)
-                resp = recv_msgpack(req)
-                req.close()
-                ctx.term()
-                
-                received_clock = resp.get("data", {}).get("clock", 0)
-                update_clock(received_clock)
-                print(f"[SERVER] Resposta de eleição recebida de {srv_name}")
-                break
-            except Exception as e:
-                print(f"[SERVER] Erro ao conectar com {srv.get('name')}: {e}")
-                continue
+        replies = request_many(names, "election", {"token": known_token}, timeout=ELECTION_TIMEOUT,
+                               stop_on_first=lambda r: r.get("data", {}).get("election") == "OK")
+        for reply in replies.values():
+            observe_token(reply.get("data", {}).get("token", 0))
+        # Réplica cujo papel ainda não era conhecido responde, mas recusa
+        replies = {p: r for p, r in replies.items() if r.get("data", {}).get("election") == "OK"}
+    
+    elapsed = (time.time() - start) * 1000
+    if replies:
+        winner = next(iter(replies))
+        print(f"[SERVER] Resposta de eleição recebida de {winner} em {elapsed:.0f}ms, aguardando anúncio")
+        result = f"cedida a {winner}"
+    else:
+        # Sou o coordenador (menor rank vivo ou único): abre novo mandato
+        announce_coordinator()
+        print(f"[SERVER] Eleito como coordenador (rank {server_rank}) em {elapsed:.0f}ms")
+        result = "eleito"
+    with election_lock:
+        last_election.update({
+            "started": start,
+            "duration_ms": round(elapsed, 1),
+            "candidates": len(candidates),
+            "result": result,
+        })
+
+
+def trigger_election():
+    """Inicia uma eleição em background, se nenhuma estiver em andamento"""
+    def run():
+        try:
+            start_election()
+        finally:
+            election_running.clear()
+
+    if election_running.is_set():
+        return
+    election_running.set()
+    threading.Thread(target=run, daemon=True).start()
+
 
+def load_lease_token():
+    """Recupera o maior fencing token já visto (sobrevive a reinícios)"""
+    state = ensure_file(LEASE_FILE, {"token": 0})
+    with coordinator_lock:
+        lease["max_token"] = max(lease["max_token"], state.get("token", 0))
 
-def announce_coordinator():
-    # Publica no tópico "servers"
+
+def save_lease_token():
+    """Persiste o maior token visto (chamar com coordinator_lock)"""
+    tmp = LEASE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"token": lease["max_token"]}, f, indent=4)
+    os.replace(tmp, LEASE_FILE)
+
+
+def observe_token(token):
+    """Registra um token visto em outro servidor; o próximo mandato fica acima dele"""
+    with coordinator_lock:
+        if token > lease["max_token"]:
+            lease["max_token"] = token
+            save_lease_token()
+
+
+def accept_lease(holder, token, rank, duration):
+    """Aplica uma concessão recebida. Rejeita tokens antigos (fencing); em
+    empate de token (eleições simultâneas) vence o menor rank"""
+    global coordinator
+    with coordinator_lock:
+        if token < lease["max_token"]:
+            return False
+        if token == lease["token"] and lease["coordinator"] not in (None, holder):
+            if lease["rank"] is not None and (rank is None or rank >= lease["rank"]):
+                return False
+        previous = lease["coordinator"]
+        lease.update({
+            "coordinator": holder,
+            "token": token,
+            "rank": rank,
+            "expires": time.time() + duration,
+        })
+        if token > lease["max_token"]:
+            lease["max_token"] = token
+            save_lease_token()
+        coordinator = holder
+    if previous != holder:
+        # Só a troca de dono acorda a lease_thread; renovações apenas estendem
+        # o prazo que ela confere ao acordar
+        print(f"[LEASE] Coordenador: {holder} (token {token})")
+        lease_changed.set()
+    return True
+
+
+def lease_status():
+    with coordinator_lock:
+        return {
+            "coordinator": lease["coordinator"],
+            "token": lease["token"],
+            "max_token": lease["max_token"],
+            "remaining": round(max(0.0, lease["expires"] - time.time()), 2),
+        }
+
+
+def announce_coordinator(renewal=False):
+    """Concede (ou renova) o lease para este servidor e publica no tópico
+    "servers". Um mandato novo sempre usa token maior que qualquer já visto"""
+    global coordinator
+    with coordinator_lock:
+        if renewal and lease["coordinator"] != server_name:
+            return  # Fomos destituídos entre a checagem e a renovação
+        if renewal and lease["token"] < lease["max_token"]:
+            renewal = False  # Alguém viu token maior: abre novo mandato
+        if not renewal:
+            lease["max_token"] += 1
+            lease["token"] = lease["max_token"]
+            save_lease_token()
+        lease.update({
+            "coordinator": server_name,
+            "rank": server_rank,
+            "expires": time.time() + LEASE_DURATION,
+        })
+        previous = coordinator
+        coordinator = server_name
+        token = lease["token"]
+    if previous != server_name:
+        lease_changed.set()
+
+    # Publica no tópico "servers": "election" anuncia novo mandato (a UI
+    # escuta) e "lease" apenas renova o mandato atual
     try:
-        ctx = zmq.Context()
-        pub = ctx.socket(zmq.PUB)
-        pub.connect("tcp://proxy:5557")
-        
         clock = increment_clock()
         msg = {
-            "service": "election",
+            "service": "lease" if renewal else "election",
             "data": {
                 "coordinator": server_name,
+                "token": token,
+                "rank": server_rank,
+                "lease": LEASE_DURATION,
                 "timestamp": time.time(),
                 "clock": clock,
             },
         }
-        packed = msgpack.packb(msg, use_bin_type=True)
-        pub.send_multipart([b"servers", packed])
-        pub.close()
-        ctx.term()
-        print(f"[SERVER] Coordenador anunciado: {server_name}")
+        publish("servers", msg)
+        if not renewal:
+            print(f"[SERVER] Coordenador anunciado: {server_name} (token {token})")
     except Exception as e:
         print(f"[SERVER] Erro ao anunciar coordenador: {e}")
 
 
-# ---------- Threads de background ----------
-def heartbeat_thread():
-    while True:
-        time.sleep(5)
-        send_heartbeat()
+# ---------- Agendador de manutenção (timer wheel) ----------
+HEARTBEAT_REFERENCE_INTERVAL = 5  # Segundos entre heartbeats ao serviço de referência
+SCHEDULER_TICK = 0.1  # Segundos por posição da roda
+SCHEDULER_SLOTS = 512  # Uma volta = 51,2s; atrasos maiores contam voltas
+SCHEDULER_WORKERS = 2  # Threads que executam as tarefas
+SCHEDULER_JITTER = 0.1  # ±10% em cada intervalo: servidores não disparam juntos
+
+
+class TimerWheel:
+    """Roda de temporização (hashed timing wheel): uma única thread cuida de
+    todos os timers, e agendar/disparar custa O(1). As tarefas rodam em um
+    pool pequeno de workers, então uma tarefa lenta (rede) não atrasa a roda,
+    e a mesma tarefa nunca roda duas vezes ao mesmo tempo"""
+
+    def __init__(self, tick=SCHEDULER_TICK, slots=SCHEDULER_SLOTS, workers=SCHEDULER_WORKERS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.cursor = 0
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.jobs = {}  # nome -> estado da tarefa
+        self.ready = queue.Queue()
+
+    def add_job(self, name, fn, interval, jitter=SCHEDULER_JITTER, first_delay=None):
+        """Registra uma tarefa periódica (first_delay=None: primeiro disparo após interval)"""
+        with self.lock:
+            self.jobs[name] = {
+                "fn": fn,
+                "interval": interval,
+                "jitter": jitter,
+                "busy": False,  # Na fila ou executando
+                "runs": 0,
+                "skipped": 0,
+                "last_ms": None,
+            }
+        self._arm(name, interval if first_delay is None else first_delay)
+
+    def _arm(self, name, delay):
+        with self.lock:
+            job = self.jobs[name]
+            delay *= 1 + random.uniform(-job["jitter"], job["jitter"])
+            ticks = max(1, int(round(delay / self.tick)))
+            slot = (self.cursor + ticks) % len(self.slots)
+            # Voltas completas que a entrada ainda precisa esperar no slot
+            self.slots[slot].append([(ticks - 1) // len(self.slots), name])
+
+    def trigger(self, name):
+        """Executa a tarefa assim que houver worker livre (não bloqueia quem chama);
+        disparos com a tarefa já pendente são agrupados em um só"""
+        with self.lock:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            if job["busy"]:
+                job["skipped"] += 1
+                return
+            job["busy"] = True
+        self.ready.put(name)
+
+    def _advance(self):
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            entries = self.slots[self.cursor]
+            due = [name for rounds, name in entries if rounds == 0]
+            self.slots[self.cursor] = [[rounds - 1, name] for rounds, name in entries if rounds > 0]
+        for name in due:
+            self.trigger(name)
+            self._arm(name, self.jobs[name]["interval"])
+
+    def _worker(self):
+        while True:
+            name = self.ready.get()
+            job = self.jobs[name]
+            start = time.time()
+            try:
+                job["fn"]()
+            except Exception as e:
+                print(f"[SCHEDULER] Erro na tarefa {name}: {e}")
+            finally:
+                with self.lock:
+                    job["busy"] = False
+                    job["runs"] += 1
+                    job["last_ms"] = round((time.time() - start) * 1000, 1)
+
+    def run(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._advance()
+
+    def status(self):
+        with self.lock:
+            return {
+                name: {
+                    "interval": job["interval"],
+                    "runs": job["runs"],
+                    "skipped": job["skipped"],
+                    "last_ms": job["last_ms"],
+                }
+                for name, job in self.jobs.items()
+            }
 
 
-def sync_thread():
-    while True:
-        time.sleep(30)
-        if coordinator:
-            sync_physical_clock()
+scheduler = TimerWheel()
 
 
-def election_thread():
-    """Thread que tenta fazer eleição periodicamente se necessário"""
-    global server_rank, coordinator
+def lease_thread():
+    """Coordenador: renova o lease periodicamente. Demais: dormem até o lease
+    expirar (ou o coordenador mudar) e só então disparam a eleição"""
+    global coordinator
+    # Na partida, espera uma renovação de um coordenador que já esteja ativo
+    lease_changed.wait(LEASE_DURATION)
+    lease_changed.clear()
     while True:
-        time.sleep(10)  # Tenta a cada 10 segundos
-        # Se não temos rank, tenta obter
         if server_rank is None:
             print("[SERVER] Tentando obter rank novamente...")
             get_rank_from_reference()
-        # Se temos rank mas não temos coordenador, tenta eleição
-        if server_rank is not None:
-            with coordinator_lock:
-                coord = coordinator
-            if not coord:
+            time.sleep(LEASE_RENEW_INTERVAL)
+            continue
+        with coordinator_lock:
+            holder = lease["coordinator"]
+            remaining = lease["expires"] - time.time()
+        if holder == server_name:
+            announce_coordinator(renewal=True)
+            lease_changed.wait(LEASE_RENEW_INTERVAL)
+        elif remaining > 0:
+            lease_changed.wait(remaining)
+        elif SERVER_ROLE == "replica":
+            # Réplica não disputa: só espera o anúncio de um primário
+            lease_changed.wait(LEASE_DURATION)
+        else:
+            if holder:
+                print(f"[LEASE] Lease de {holder} expirou, iniciando eleição")
+                with coordinator_lock:
+                    if lease["coordinator"] == holder:
+                        lease["coordinator"] = None
+                        coordinator = None
+            else:
                 print("[SERVER] Sem coordenador, tentando eleição...")
-                start_election()
+            trigger_election()
+            # Dá tempo para a eleição terminar e o anúncio chegar
+            lease_changed.wait(LEASE_DURATION)
+        lease_changed.clear()
 
 
 # ---------- Replicação de dados ----------
-def replicate_operation(service, payload, pub_socket):
+def load_replication_state():
+    """Carrega epoch/seq local e posições aplicadas de cada origem"""
+    global replication_epoch, replication_seq, replication_applied
+    state = ensure_file(REPLICATION_FILE, {})
+    if not state.get("epoch"):
+        # Dados novos (ou apagados): nova encarnação, peers reiniciam a contagem
+        state = {"epoch": uuid.uuid4().hex, "seq": 0, "applied": {}}
+    with replication_lock:
+        replication_epoch = state["epoch"]
+        replication_seq = state.get("seq", 0)
+        replication_applied = dict(state.get("applied", {}))
+        save_replication_state()
+
+
+def save_replication_state():
+    """Persiste a posição de replicação (chamar com replication_lock)"""
+    state = {
+        "epoch": replication_epoch,
+        "seq": replication_seq,
+        "applied": replication_applied,
+    }
+    tmp = REPLICATION_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp, REPLICATION_FILE)
+
+
+def next_replication_seq():
+    global replication_seq
+    with replication_lock:
+        replication_seq += 1
+        save_replication_state()
+        return replication_epoch, replication_seq
+
+
+def replication_position():
+    """Vetor {origem: {epoch, seq}} incluindo a posição do próprio servidor"""
+    with replication_lock:
+        position = {src: dict(pos) for src, pos in replication_applied.items()}
+        position[server_name] = {"epoch": replication_epoch, "seq": replication_seq}
+        return position
+
+
+def is_already_applied(source, epoch, seq):
+    if seq is None:
+        return False  # Mensagem sem posição (formato antigo): aplica sempre
+    with replication_lock:
+        last = replication_applied.get(source)
+        return bool(last) and last.get("epoch") == epoch and seq <= last.get("seq", 0)
+
+
+def record_applied(source, epoch, seq):
+    if seq is None:
+        return
+    with replication_lock:
+        last = replication_applied.get(source)
+        if not last or last.get("epoch") != epoch or seq > last.get("seq", 0):
+            replication_applied[source] = {"epoch": epoch, "seq": seq}
+            save_replication_state()
+        announced = peer_positions.get(source)
+        if announced and announced["epoch"] == epoch and seq >= announced["seq"]:
+            announced["caught_up"] = time.time()
+
+
+def note_peer_position(peer, epoch, seq):
+    """Posição anunciada por um peer no heartbeat. Se já aplicamos tudo até
+    ela, estamos em dia com o peer neste instante"""
+    if seq is None:
+        return
+    with replication_lock:
+        entry = peer_positions.setdefault(peer, {"epoch": epoch, "seq": 0, "caught_up": None})
+        entry["epoch"], entry["seq"] = epoch, seq
+        applied = replication_applied.get(peer)
+        if seq == 0 or (applied and applied.get("epoch") == epoch and applied.get("seq", 0) >= seq):
+            entry["caught_up"] = time.time()
+
+
+def staleness(peer):
+    """Segundos desde a última vez em que estávamos em dia com o peer (None = desconhecido)"""
+    with replication_lock:
+        entry = peer_positions.get(peer)
+        if not entry or entry["caught_up"] is None:
+            return None
+        return time.time() - entry["caught_up"]
+
+
+def replicate_operation(service, payload):
     """Publica operação no tópico de replicação para outros servidores"""
     global replication_enabled
     if not replication_enabled:
         return
-    
+
     try:
         clock = increment_clock()
+        epoch, seq = next_replication_seq()
         replication_msg = {
             "service": f"replicate_{service}",
             "data": {
                 "operation": service,
                 "payload": payload,
                 "source": server_name,
+                "epoch": epoch,
+                "seq": seq,
                 "timestamp": time.time(),
                 "clock": clock,
             },
         }
-        packed = msgpack.packb(replication_msg, use_bin_type=True)
-        pub_socket.send_multipart([b"replication", packed])
+        # Com a malha habilitada a replicação não passa pelo proxy
+        publish("replication", replication_msg, route="mesh" if REPLICATION_MESH else "proxy")
         print(f"[REPLICATION] Operação '{service}' replicada para outros servidores")
+        return replication_msg
     except Exception as e:
         print(f"[REPLICATION] Erro ao replicar operação: {e}")
 
 
-def apply_replication(operation, payload):
-    """Aplica uma operação de replicação recebida de outro servidor"""
+def apply_replication(operation, payload, record_position=True):
+    """Aplica uma operação de replicação recebida de outro servidor. Devolve
+    True se a operação foi aplicada ou já estava no estado local (só então o
+    quórum confirma a cópia)"""
     global replication_enabled
     if not replication_enabled:
-        return
+        return False
     
     try:
         data = load_data()
@@ -400,24 +1886,35 @@ def apply_replication(operation, payload):
         
         # Não aplicar se for do próprio servidor (evitar loops)
         if source == server_name:
-            return
-        
+            return True
+
+        # Ignora operações já contidas no estado local (ex: vindas do snapshot)
+        epoch = payload.get("epoch")
+        seq = payload.get("seq")
+        if is_already_applied(source, epoch, seq):
+            return True
+
         print(f"[REPLICATION] Aplicando operação '{operation}' de {source}")
+        applied = False  # Aplicada agora ou já presente (duplicata)
         
         if operation == "login":
             username = payload.get("payload", {}).get("user")
             if username and username not in data["users"]:
                 data["users"].append(username)
                 save_data(data)
+                bump_version("users")
                 save_login(username)
                 print(f"[REPLICATION] Usuário '{username}' replicado de {source}")
+            applied = bool(username)
         
         elif operation == "channel":
             ch = payload.get("payload", {}).get("channel")
             if ch and ch not in data["channels"]:
                 data["channels"].append(ch)
                 save_data(data)
+                bump_version("channels")
                 print(f"[REPLICATION] Canal '{ch}' replicado de {source}")
+            applied = bool(ch)
         
         elif operation == "publish":
             payload_data = payload.get("payload", {})
@@ -428,20 +1925,14 @@ def apply_replication(operation, payload):
                 "timestamp": payload_data.get("timestamp"),
                 "clock": payload.get("clock", 0),
             }
-            # Verifica se a mensagem já existe (evitar duplicatas) usando user, channel, message, timestamp e clock
-            messages = data.get("messages", [])
-            exists = any(
-                m.get("user") == msg_obj.get("user") and
-                m.get("channel") == msg_obj.get("channel") and
-                m.get("message") == msg_obj.get("message") and
-                abs(m.get("timestamp", 0) - msg_obj.get("timestamp", 0)) < 1.0 and
-                m.get("clock") == msg_obj.get("clock")
-                for m in messages
-            )
-            if not exists:
+            # Mesma identidade do digest: uma cópia vinda da anti-entropia
+            # (com outro clock) não é gravada de novo
+            if not message_stored(data, msg_obj):
                 data.setdefault("messages", []).append(msg_obj)
                 save_data(data)
+                index_message(msg_obj)
                 print(f"[REPLICATION] Mensagem replicada de {source}")
+            applied = True
         
         elif operation == "message":
             payload_data = payload.get("payload", {})
@@ -453,20 +1944,12 @@ def apply_replication(operation, payload):
                 "timestamp": payload_data.get("timestamp"),
                 "clock": payload.get("clock", 0),
             }
-            # Verifica se a mensagem já existe (evitar duplicatas) usando src, dst, message, timestamp e clock
-            messages = data.get("messages", [])
-            exists = any(
-                m.get("src") == msg_obj.get("src") and
-                m.get("dst") == msg_obj.get("dst") and
-                m.get("message") == msg_obj.get("message") and
-                abs(m.get("timestamp", 0) - msg_obj.get("timestamp", 0)) < 1.0 and
-                m.get("clock") == msg_obj.get("clock")
-                for m in messages
-            )
-            if not exists:
+            if not message_stored(data, msg_obj):
                 data.setdefault("messages", []).append(msg_obj)
                 save_data(data)
+                index_message(msg_obj)
                 print(f"[REPLICATION] Mensagem privada replicada de {source}")
+            applied = True
         
         elif operation == "subscribe":
             user = payload.get("payload", {}).get("user")
@@ -478,49 +1961,308 @@ def apply_replication(operation, payload):
                     user_subs.append(ch)
                     save_data(data)
                     print(f"[REPLICATION] Inscrição {user}@{ch} replicada de {source}")
-    
+                applied = True
+
+        elif operation == "inbox_ack":
+            op = payload.get("payload", {})
+            if op.get("user") and inbox_ack(data, op["user"], float(op.get("cursor") or 0)):
+                save_data(data)
+                print(f"[REPLICATION] Entrega offline de {op['user']} replicada de {source}")
+            applied = bool(op.get("user"))
+
+        elif operation == "mark_read":
+            op = payload.get("payload", {})
+            kind = "channels" if op.get("channel") else "peers"
+            name = op.get("channel") or op.get("peer")
+            if op.get("user") and name and set_read_cursor(data, op["user"], kind, name, float(op.get("cursor") or 0)):
+                save_data(data)
+                print(f"[REPLICATION] Cursor de leitura {op['user']}@{name} replicado de {source}")
+            applied = bool(op.get("user") and name)
+
+        # Cópias diretas (quórum) não avançam a posição: a mesma operação
+        # ainda chega pelo fluxo Pub/Sub, que mantém a ordem por origem
+        if record_position:
+            record_applied(source, epoch, seq)
+        return applied
+
     except Exception as e:
         print(f"[REPLICATION] Erro ao aplicar replicação: {e}")
+        return False
+
+
+# ---------- Quórum de escrita (write concern) ----------
+def refresh_peers():
+    """Atualiza a lista de peers a partir da referência (tarefa do agendador
+    a cada PEER_LIST_TTL: a consulta nunca fica no caminho de um pedido).
+    Se a referência não responder, mantém a lista anterior"""
+    servers = get_server_list()
+    if servers:
+        peer_cache["peers"] = [
+            s.get("name") for s in servers if s.get("name") and s.get("name") != server_name
+        ]
+    peer_cache["updated"] = time.time()
+
+
+def get_peers():
+    """Nomes dos outros servidores ativos (lista mantida por refresh_peers)"""
+    return peer_cache["peers"]
+
+
+def get_quorum_socket(peer):
+    sock = quorum_sockets.get(peer)
+    if sock is None:
+        sock = zmq.Context.instance().socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.SNDHWM, 1000)
+        sock.connect(f"tcp://{peer}:{QUORUM_PORT}")
+        quorum_sockets[peer] = sock
+    return sock
+
+
+def quorum_ack_thread():
+    """Aplica as cópias diretas de escrita com write concern e confirma (ROUTER
+    na porta QUORUM_PORT). Fica fora do REP dos clientes: um servidor que está
+    esperando o quórum da própria escrita continua confirmando as dos outros"""
+    sock = zmq.Context.instance().socket(zmq.ROUTER)
+    sock.bind(f"tcp://*:{QUORUM_PORT}")
+    print(f"[QUORUM] Acks de replicação em tcp://*:{QUORUM_PORT}")
+    while True:
+        frames = sock.recv_multipart(copy=False)
+        try:
+            msg = unpack(frames[-1])
+            payload = msg.get("data", {})
+            update_clock(payload.get("clock", 0))
+            with data_lock:
+                applied = apply_replication(msg.get("service", "").replace("replicate_", ""), payload,
+                                            record_position=False)
+            # Só confirma o que ficou gravado (ou já estava): erro não conta no quórum
+            ack = {"service": "replication",
+                   "data": {"status": "ok" if applied else "erro",
+                            "source": payload.get("source"), "seq": payload.get("seq")}}
+        except Exception as e:
+            print(f"[QUORUM] Cópia direta inválida: {e}")
+            continue
+        sock.send_multipart([frames[0], b"", pack(ack)])
+
+
+def required_acks(write_concern, cluster_size):
+    """Confirmações de peers necessárias (o próprio servidor conta como uma)"""
+    if write_concern == "one":
+        return 1
+    if write_concern == "majority":
+        return cluster_size // 2
+    return 0
+
+
+def wait_for_acks(replication_msg, write_concern):
+    """Envia a operação direto aos peers (DEALER -> ROUTER na QUORUM_PORT,
+    atendido por quorum_ack_thread) e espera os acks"""
+    peers = get_peers()
+    required = required_acks(write_concern, len(peers) + 1)
+    if required == 0 or replication_msg is None:
+        return 0, required
+
+    packed = compress_frame(pack(replication_msg), SUPPORTED_COMPRESSION)
+    seq = replication_msg["data"]["seq"]
+    poller = zmq.Poller()
+    pending = 0
+    for peer in peers:
+        sock = get_quorum_socket(peer)
+        try:
+            sock.send_multipart([b"", packed], zmq.NOBLOCK)
+            pending += 1
+        except zmq.Again:
+            continue  # Fila cheia: peer fora do ar há muito tempo
+        poller.register(sock, zmq.POLLIN)
+
+    acks = 0
+    deadline = time.time() + QUORUM_TIMEOUT / 1000
+    while acks < required and acks + pending >= required:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        for sock, _ in poller.poll(remaining * 1000):
+            resp = unpack(sock.recv_multipart(copy=False)[-1]).get("data", {})
+            # Acks atrasados de escritas anteriores são descartados
+            if resp.get("source") != server_name or resp.get("seq") != seq:
+                continue
+            pending -= 1
+            if resp.get("status") == "ok":
+                acks += 1
+    return acks, required
+
+
+def apply_write_concern(resp, write_concern, replication_msg):
+    """Só confirma a escrita ao cliente depois dos acks exigidos (chamar sem
+    o data_lock)"""
+    if write_concern == "local":
+        return
+    start = time.time()
+    acks, required = wait_for_acks(replication_msg, write_concern)
+    elapsed = (time.time() - start) * 1000
+    resp["data"].update({"write_concern": write_concern, "acks": acks, "required": required})
+    print(f"[QUORUM] {write_concern}: {acks}/{required} acks em {elapsed:.1f}ms")
+    if acks < required:
+        resp["data"]["status"] = "erro"
+        resp["data"]["description"] = (
+            f"Mensagem gravada localmente, mas quórum não atingido ({acks}/{required} confirmações)"
+        )
+
+
+# ---------- Papel de réplica (roteamento leitura/escrita) ----------
+FORWARD_TIMEOUT = PEER_TIMEOUT + QUORUM_TIMEOUT  # ms: a escrita pode esperar quorum no writer
+
+
+def writer_target():
+    if WRITER_HOST:
+        return WRITER_HOST
+    with coordinator_lock:
+        coord = coordinator
+    return coord if coord != server_name else None
+
+
+def replica_staleness_ms():
+    target = writer_target()
+    lag = staleness(target) if target else None
+    return None if lag is None else round(lag * 1000, 1)
+
+
+def forward_request(request):
+    """Encaminha o pedido ao writer e devolve a resposta dele ao cliente"""
+    service = request.get("service")
+    target = writer_target()
+    if not target:
+        return {
+            "service": service,
+            "data": {
+                "status": "erro",
+                "timestamp": time.time(),
+                "clock": increment_clock(),
+                "description": "Réplica somente leitura sem writer disponível",
+            },
+        }
+    try:
+        resp = get_peer_connection(target).request(service, request.get("data", {}), timeout=FORWARD_TIMEOUT)
+        resp.setdefault("data", {})["served_by"] = target
+        return resp
+    except (TimeoutError, PeerUnavailable) as e:
+        print(f"[REPLICA] Falha ao encaminhar '{service}' para {target}: {e}")
+        return {
+            "service": service,
+            "data": {
+                "status": "erro",
+                "timestamp": time.time(),
+                "clock": increment_clock(),
+                "description": f"Writer {target} indisponível",
+            },
+        }
+
+
+def route_request(request):
+    """Na réplica somente leitura, decide o que não é atendido localmente:
+    escritas vão para o writer, e leituras com max_staleness_ms também, se o
+    atraso local passar do limite pedido. None = atender aqui"""
+    if SERVER_ROLE != "replica":
+        return None
+    service = request.get("service")
+    if service in WRITE_SERVICES:
+        return forward_request(request)
+    if service in READ_SERVICES:
+        bound = request.get("data", {}).get("max_staleness_ms")
+        if bound is not None:
+            lag = replica_staleness_ms()
+            if lag is None or lag > bound:
+                return forward_request(request)
+    return None
 
 
 # ---------- lógica de serviços ----------
-def handle_request(request, is_replication=False, pub_socket=None):
-    global coordinator, message_count
+def int_param(value, default):
+    """Inteiro positivo vindo do pedido (default se ausente); None se inválido"""
+    if value is None:
+        return default
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        return None
+    return n if n >= 1 else None
+
+
+def error_response(request, description):
+    """Resposta de erro no formato dos serviços (usada quando o pedido não
+    pôde ser atendido)"""
+    service = request.get("service") if isinstance(request, dict) else None
+    return {
+        "service": service,
+        "data": {
+            "status": "erro",
+            "timestamp": time.time(),
+            "clock": increment_clock(),
+            "description": description,
+        },
+    }
+
+
+def count_request():
+    """Conta o pedido e agenda a sincronização de Berkeley a cada SYNC_INTERVAL"""
+    global message_count
+    with message_count_lock:
+        message_count += 1
+        due = message_count % SYNC_INTERVAL == 0
+    if due:
+        # Só agenda: a rodada de Berkeley roda em background, fora da
+        # latência deste pedido
+        scheduler.trigger("berkeley")
+
+
+def handle_request(request, is_replication=False):
+    global coordinator
     
     # Atualiza relógio lógico ao receber mensagem
     received_clock = request.get("data", {}).get("clock", 0)
     if received_clock > 0:
         update_clock(received_clock)
     
-    data = load_data()
     service = request.get("service")
     payload = request.get("data", {})
+    # O histórico recente sai do cache em memória e conversations/unread dos
+    # índices e metadados em memória: esses não leem o disco
+    if service == "history":
+        data = None
+    elif service in ("conversations", "unread"):
+        data = data_meta
+    else:
+        data = load_data()
     
     # Se for uma operação de replicação, aplica e retorna sem processar
     if service and service.startswith("replicate_"):
         operation = service.replace("replicate_", "")
-        apply_replication(operation, payload)
-        # Retorna resposta vazia para operações de replicação
-        return {"service": "replication", "data": {"status": "ok"}}, None
+        apply_replication(operation, payload, record_position=False)
+        # Confirmação (ack) identificada pela origem/seq da operação
+        return {
+            "service": "replication",
+            "data": {"status": "ok", "source": payload.get("source"), "seq": payload.get("seq")},
+        }, None, None
     
     print(f"[SERVER] Serviço: {service} | Payload: {payload} | Clock: {get_clock()}")
     pub_info = None  # (topic, payload_dict)
+    quorum = None  # (write_concern, replication_msg): acks esperados fora do data_lock
     needs_replication = False  # Flag para indicar se precisa replicar
     
     # Incrementa contador de mensagens (apenas se não for replicação)
     if not is_replication:
-        with message_count_lock:
-            message_count += 1
-            if message_count % SYNC_INTERVAL == 0:
-                sync_physical_clock()
+        count_request()
 
     if service == "login":
         username = payload.get("user")
-        ts = time.time()
+        ts = physical_time()
         clock = increment_clock()
         if username not in data["users"]:
             data["users"].append(username)
             save_data(data)
+            bump_version("users")
             save_login(username)
             print(f"[SERVER] Novo usuário: {username}")
             needs_replication = True  # Precisa replicar novo usuário
@@ -531,8 +2273,31 @@ def handle_request(request, is_replication=False, pub_socket=None):
         resp = {"service": "login", "data": {"status": "sucesso", "timestamp": ts, "clock": clock}}
         
         # Replica operação se não for de replicação
-        if needs_replication and not is_replication and pub_socket:
-            replicate_operation("login", payload, pub_socket)
+        if needs_replication and not is_replication:
+            replicate_operation("login", payload)
+
+        # Entrega de uma vez as mensagens privadas recebidas enquanto offline
+        pending = inbox_pending(data, username)
+        resp["data"]["inbox"] = pending
+        if pending:
+            cursor = pending[-1].get("timestamp") or 0
+            if inbox_ack(data, username, cursor):
+                save_data(data)
+                if not is_replication:
+                    replicate_operation("inbox_ack", {"user": username, "cursor": cursor})
+            print(f"[SERVER] {len(pending)} mensagens offline entregues a {username}")
+
+    elif service == "logout":
+        # O que chegou até aqui foi visto ao vivo: não volta no próximo login
+        username = payload.get("user")
+        ts = physical_time()
+        clock = increment_clock()
+        cursor = inbox_latest(username)
+        if username in data["users"] and cursor and inbox_ack(data, username, cursor):
+            save_data(data)
+            if not is_replication:
+                replicate_operation("inbox_ack", {"user": username, "cursor": cursor})
+        resp = {"service": "logout", "data": {"status": "sucesso", "timestamp": ts, "clock": clock}}
 
     elif service == "users":
         clock = increment_clock()
@@ -543,19 +2308,20 @@ def handle_request(request, is_replication=False, pub_socket=None):
 
     elif service == "channel":
         ch = payload.get("channel")
-        ts = time.time()
+        ts = physical_time()
         clock = increment_clock()
         if ch not in data["channels"]:
             data["channels"].append(ch)
             save_data(data)
+            bump_version("channels")
             print(f"[SERVER] Canal criado: {ch}")
             resp = {
                 "service": "channel",
                 "data": {"status": "sucesso", "timestamp": ts, "clock": clock},
             }
             # Replica operação se não for de replicação
-            if not is_replication and pub_socket:
-                replicate_operation("channel", payload, pub_socket)
+            if not is_replication:
+                replicate_operation("channel", payload)
         else:
             resp = {
                 "service": "channel",
@@ -577,7 +2343,7 @@ def handle_request(request, is_replication=False, pub_socket=None):
     elif service == "subscribe":
         user = payload.get("user")
         ch = payload.get("channel")
-        ts = time.time()
+        ts = physical_time()
         clock = increment_clock()
 
         if user not in data["users"]:
@@ -586,32 +2352,144 @@ def handle_request(request, is_replication=False, pub_socket=None):
                 "service": "subscribe",
                 "data": {"status": "erro", "timestamp": ts, "clock": clock, "description": msg},
             }
-        elif ch not in data["channels"]:
-            msg = "Canal inexistente"
+        elif ch not in data["channels"]:
+            msg = "Canal inexistente"
+            resp = {
+                "service": "subscribe",
+                "data": {"status": "erro", "timestamp": ts, "clock": clock, "description": msg},
+            }
+        else:
+            subs = data.setdefault("subscriptions", {})
+            user_subs = subs.setdefault(user, [])
+            if ch not in user_subs:
+                user_subs.append(ch)
+                save_data(data)
+                print(f"[SERVER] {user} inscrito em {ch}")
+                # Replica operação se não for de replicação
+                if not is_replication:
+                    replicate_operation("subscribe", payload)
+            resp = {
+                "service": "subscribe",
+                "data": {"status": "sucesso", "timestamp": ts, "clock": clock},
+            }
+
+    elif service == "mark_read":
+        # Marca como lido até "cursor" (padrão: a mensagem mais recente) no
+        # canal ("channel") ou na conversa privada com "peer"
+        user = payload.get("user")
+        ch = payload.get("channel")
+        peer = payload.get("peer")
+        cursor = payload.get("cursor")
+        ts = physical_time()
+        clock = increment_clock()
+        if user not in data["users"] or not (ch or peer):
+            resp = {
+                "service": "mark_read",
+                "data": {
+                    "status": "erro",
+                    "timestamp": ts,
+                    "clock": clock,
+                    "description": "Usuário inexistente" if user not in data["users"] else "channel ou peer é obrigatório",
+                },
+            }
+        elif cursor is not None and (isinstance(cursor, bool) or not isinstance(cursor, (int, float)) or cursor < 0):
+            resp = {
+                "service": "mark_read",
+                "data": {
+                    "status": "erro",
+                    "timestamp": ts,
+                    "clock": clock,
+                    "description": "cursor deve ser um timestamp (número não negativo)",
+                },
+            }
+        else:
+            kind, name, key = ("channels", ch, f"ch:{ch}") if ch else ("peers", peer, dm_key(user, peer))
+            cursor = float(cursor or latest_time(key))
+            if set_read_cursor(data, user, kind, name, cursor):
+                save_data(data)
+                if not is_replication:
+                    # Replica o cursor já resolvido (a última mensagem pode diferir entre réplicas)
+                    replicate_operation("mark_read", {"user": user, "channel": ch, "peer": peer, "cursor": cursor})
+            resp = {
+                "service": "mark_read",
+                "data": {
+                    "status": "sucesso",
+                    "timestamp": ts,
+                    "clock": clock,
+                    "cursor": read_cursor(data, user, kind, name, key),
+                    "unread": unread_count(data, user, kind, name, key),
+                },
+            }
+
+    elif service == "unread":
+        # Não lidas por canal inscrito e por conversa privada, sem varrer mensagens
+        user = payload.get("user")
+        clock = increment_clock()
+        if user not in data["users"]:
+            resp = {
+                "service": "unread",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "Usuário inexistente",
+                },
+            }
+        else:
+            channels = {
+                ch: unread_count(data, user, "channels", ch, f"ch:{ch}")
+                for ch in data["subscriptions"].get(user, [])
+            }
+            peers = {
+                peer: unread_count(data, user, "peers", peer, dm_key(user, peer))
+                for peer in conversation_peers(user)
+            }
+            resp = {
+                "service": "unread",
+                "data": {
+                    "status": "sucesso",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "channels": channels,
+                    "peers": peers,
+                    "total": sum(channels.values()) + sum(peers.values()),
+                },
+            }
+
+    elif service == "conversations":
+        # Caixa de entrada: conversas privadas com a última mensagem, total e não lidas
+        user = payload.get("user")
+        clock = increment_clock()
+        if user not in data["users"]:
             resp = {
-                "service": "subscribe",
-                "data": {"status": "erro", "timestamp": ts, "clock": clock, "description": msg},
+                "service": "conversations",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "Usuário inexistente",
+                },
             }
         else:
-            subs = data.setdefault("subscriptions", {})
-            user_subs = subs.setdefault(user, [])
-            if ch not in user_subs:
-                user_subs.append(ch)
-                save_data(data)
-                print(f"[SERVER] {user} inscrito em {ch}")
-                # Replica operação se não for de replicação
-                if not is_replication and pub_socket:
-                    replicate_operation("subscribe", payload, pub_socket)
+            conversations = conversation_list(user)
+            for c in conversations:
+                c["unread"] = unread_count(data, user, "peers", c["peer"], dm_key(user, c["peer"]))
             resp = {
-                "service": "subscribe",
-                "data": {"status": "sucesso", "timestamp": ts, "clock": clock},
+                "service": "conversations",
+                "data": {
+                    "status": "sucesso",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "conversations": conversations,
+                },
             }
 
     elif service == "publish":
         user = payload.get("user")
         ch = payload.get("channel")
         msg_txt = payload.get("message")
-        ts = payload.get("timestamp", time.time())
+        ts = physical_time()
+        write_concern = payload.get("write_concern", "local")
         clock = increment_clock()
 
         if user not in data["users"]:
@@ -636,6 +2514,16 @@ def handle_request(request, is_replication=False, pub_socket=None):
                     "description": msg,
                 },
             }
+        elif write_concern not in WRITE_CONCERNS:
+            resp = {
+                "service": "publish",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": f"write_concern inválido (use {', '.join(WRITE_CONCERNS)})",
+                },
+            }
         else:
             msg_obj = {
                 "user": user,
@@ -646,6 +2534,7 @@ def handle_request(request, is_replication=False, pub_socket=None):
             }
             data.setdefault("messages", []).append(msg_obj)
             save_data(data)
+            index_message(msg_obj)
             print(f"[SERVER] Msg {user}@{ch}: {msg_txt}")
             resp = {
                 "service": "publish",
@@ -653,15 +2542,18 @@ def handle_request(request, is_replication=False, pub_socket=None):
             }
             pub_info = (ch, msg_obj)
             # Replica operação se não for de replicação
-            if not is_replication and pub_socket:
-                replicate_operation("publish", payload, pub_socket)
+            replication_msg = None
+            if not is_replication:
+                replication_msg = replicate_operation("publish", {**payload, "timestamp": ts})
+            quorum = (write_concern, replication_msg)
 
     elif service == "message":
         # Mensagens privadas entre usuários
         src = payload.get("src")
         dst = payload.get("dst")
         msg_txt = payload.get("message")
-        ts = payload.get("timestamp", time.time())
+        ts = physical_time()
+        write_concern = payload.get("write_concern", "local")
         clock = increment_clock()
 
         if src not in data["users"]:
@@ -686,6 +2578,16 @@ def handle_request(request, is_replication=False, pub_socket=None):
                     "description": msg,
                 },
             }
+        elif write_concern not in WRITE_CONCERNS:
+            resp = {
+                "service": "message",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": f"write_concern inválido (use {', '.join(WRITE_CONCERNS)})",
+                },
+            }
         else:
             msg_obj = {
                 "src": src,
@@ -698,6 +2600,7 @@ def handle_request(request, is_replication=False, pub_socket=None):
             # Persiste mensagem privada
             data.setdefault("messages", []).append(msg_obj)
             save_data(data)
+            index_message(msg_obj)
             print(f"[SERVER] Msg privada {src} -> {dst}: {msg_txt}")
             resp = {
                 "service": "message",
@@ -706,22 +2609,50 @@ def handle_request(request, is_replication=False, pub_socket=None):
             # Publica no tópico do usuário destino
             pub_info = (dst, msg_obj)
             # Replica operação se não for de replicação
-            if not is_replication and pub_socket:
-                replicate_operation("message", payload, pub_socket)
+            replication_msg = None
+            if not is_replication:
+                replication_msg = replicate_operation("message", {**payload, "timestamp": ts})
+            quorum = (write_concern, replication_msg)
 
     elif service == "history":
+        # "limit" (opcional) pede só as últimas N mensagens; "since" (cursor
+        # de um pedido anterior) pede só as mensagens posteriores a ele
         ch = payload.get("channel")
+        limit = int_param(payload.get("limit"), None)
+        since = parse_cursor(payload.get("since"))
         clock = increment_clock()
-        msgs = [m for m in data.get("messages", []) if m.get("channel") == ch]
-        resp = {
-            "service": "history",
-            "data": {
-                "status": "sucesso",
-                "timestamp": time.time(),
-                "clock": clock,
-                "messages": msgs,
-            },
-        }
+        if limit is None and payload.get("limit") is not None:
+            resp = {
+                "service": "history",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "limit deve ser um inteiro positivo",
+                },
+            }
+        elif since is None and payload.get("since") is not None:
+            resp = {
+                "service": "history",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": CURSOR_ERROR,
+                },
+            }
+        else:
+            msgs = channel_history(ch, limit, since)
+            resp = {
+                "service": "history",
+                "data": {
+                    "status": "sucesso",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "messages": msgs,
+                    "cursor": history_cursor(msgs, since),
+                },
+            }
     
     elif service == "private_history":
         # Histórico de mensagens privadas entre dois usuários
@@ -740,15 +2671,20 @@ def handle_request(request, is_replication=False, pub_socket=None):
                     "messages": [],
                 },
             }
+        elif payload.get("since") is not None and parse_cursor(payload.get("since")) is None:
+            resp = {
+                "service": "private_history",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": CURSOR_ERROR,
+                    "messages": [],
+                },
+            }
         else:
-            # Busca mensagens privadas entre os dois usuários (em qualquer direção)
-            msgs = [
-                m for m in data.get("messages", [])
-                if m.get("dst") and (
-                    (m.get("src") == user1 and m.get("dst") == user2) or
-                    (m.get("src") == user2 and m.get("dst") == user1)
-                )
-            ]
+            since = parse_cursor(payload.get("since"))
+            msgs = private_messages(data, user1, user2, since)
             resp = {
                 "service": "private_history",
                 "data": {
@@ -756,33 +2692,217 @@ def handle_request(request, is_replication=False, pub_socket=None):
                     "timestamp": time.time(),
                     "clock": clock,
                     "messages": msgs,
+                    "cursor": history_cursor(msgs, since),
+                },
+            }
+
+    elif service == "sync":
+        # Sincronização incremental de canais e conversas privadas em um só
+        # pedido: {"channels": {canal: cursor}, "peers": {usuário: cursor}}.
+        # Sem "channels", usa as inscrições do usuário desde o início
+        user = payload.get("user")
+        clock = increment_clock()
+        if user not in data["users"]:
+            resp = {
+                "service": "sync",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "Usuário inexistente",
+                },
+            }
+        elif not sync_cursors_valid(payload.get("channels")) or not sync_cursors_valid(payload.get("peers")):
+            resp = {
+                "service": "sync",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "channels e peers devem ser objetos {nome: cursor}",
+                },
+            }
+        else:
+            channels = payload.get("channels")
+            if channels is None:
+                channels = {ch: None for ch in data["subscriptions"].get(user, [])}
+            result_channels = {}
+            for ch, since in channels.items():
+                since = parse_cursor(since) or (0.0, {})
+                msgs = channel_history(ch, since=since)
+                result_channels[ch] = {"messages": msgs, "cursor": history_cursor(msgs, since)}
+            result_peers = {}
+            for peer, since in (payload.get("peers") or {}).items():
+                since = parse_cursor(since) or (0.0, {})
+                msgs = private_messages(data, user, peer, since)
+                result_peers[peer] = {"messages": msgs, "cursor": history_cursor(msgs, since)}
+            resp = {
+                "service": "sync",
+                "data": {
+                    "status": "sucesso",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "channels": result_channels,
+                    "peers": result_peers,
                 },
             }
     
+    elif service == "search":
+        # Busca nas mensagens: "query" obrigatória; "channel", "user" (autor) e
+        # "as_user" (inclui as conversas privadas dele) opcionais; paginada
+        query = payload.get("query")
+        clock = increment_clock()
+        if not query or not tokenize(query):
+            resp = {
+                "service": "search",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "query é obrigatória",
+                },
+            }
+        elif int_param(payload.get("page"), 1) is None or int_param(payload.get("page_size"), SEARCH_PAGE_SIZE) is None:
+            resp = {
+                "service": "search",
+                "data": {
+                    "status": "erro",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "description": "page e page_size devem ser inteiros positivos",
+                },
+            }
+        else:
+            page = int_param(payload.get("page"), 1)
+            page_size = min(SEARCH_MAX_PAGE_SIZE, int_param(payload.get("page_size"), SEARCH_PAGE_SIZE))
+            results, total = search_messages(
+                query, payload.get("channel"), payload.get("user"), payload.get("as_user"), page, page_size,
+            )
+            resp = {
+                "service": "search",
+                "data": {
+                    "status": "sucesso",
+                    "timestamp": time.time(),
+                    "clock": clock,
+                    "results": results,
+                    "total": total,
+                    "page": page,
+                    "pages": math.ceil(total / page_size),
+                },
+            }
+
     elif service == "clock":
         # Serviço para sincronização de relógio físico (Berkeley)
         clock = increment_clock()
         resp = {
             "service": "clock",
             "data": {
-                "time": time.time(),
+                "time": physical_time(),
                 "timestamp": time.time(),
                 "clock": clock,
             },
         }
+
+    elif service == "clock_adjust":
+        # Correção enviada pelo coordenador ao fim da rodada de Berkeley
+        clock = increment_clock()
+        token = payload.get("token", 0)
+        known = lease_status()["max_token"]
+        delta = payload.get("adjustments", {}).get(server_name)
+        if token < known:
+            # Fencing: coordenador destituído não mexe mais no relógio
+            print(f"[LEASE] Ajuste de relógio rejeitado: token {token} < {known}")
+            status = "erro"
+        else:
+            if delta is not None:
+                adjust_physical_clock(delta)
+            status = "sucesso"
+        resp = {
+            "service": "clock_adjust",
+            "data": {"status": status, "timestamp": time.time(), "clock": clock},
+        }
     
+    elif service == "digest":
+        # Digest Merkle para anti-entropia: sem "keys" devolve raiz + hash por
+        # canal/conversa; com "keys" devolve os buckets dessas chaves
+        clock = increment_clock()
+        keys = payload.get("keys")
+        if keys:
+            digest = {"buckets": digest_buckets(keys)}
+        else:
+            digest = digest_summary(data)
+        resp = {
+            "service": "digest",
+            "data": {"status": "sucesso", "timestamp": time.time(), "clock": clock, **digest},
+        }
+
+    elif service == "digest_fetch":
+        # Conteúdo dos buckets divergentes (ou de usuários/canais/inscrições)
+        clock = increment_clock()
+        key = payload.get("key")
+        buckets = {int(b) for b in payload.get("buckets", [])}
+        resp_data = {"status": "sucesso", "timestamp": time.time(), "clock": clock}
+        if payload.get("meta"):
+            resp_data.update({
+                "users": data["users"],
+                "channels": data["channels"],
+                "subscriptions": data["subscriptions"],
+                "read_cursors": data.get("read_cursors", {}),
+                "delivered": data.get("delivered", {}),
+            })
+        if key:
+            resp_data["messages"] = [
+                m for m in data.get("messages", [])
+                if message_key(m) == key and message_bucket(m) in buckets
+            ]
+        resp = {"service": "digest_fetch", "data": resp_data}
+
+    elif service == "metrics":
+        # Serviço administrativo: lag/vazão da replicação por origem
+        clock = increment_clock()
+        resp = {
+            "service": "metrics",
+            "data": {
+                "status": "sucesso",
+                "timestamp": time.time(),
+                "clock": clock,
+                "position": replication_position(),
+                "peer_health": peer_health(),
+                "election": dict(last_election),
+                "lease": lease_status(),
+                "failure_detector": detector_status(),
+                "berkeley": {"offset_ms": round(clock_offset * 1000, 2), "last_round": dict(last_berkeley)},
+                "scheduler": scheduler.status(),
+                "history_cache": history_cache_status(),
+                "response_cache": response_cache_status(),
+                "compression": compression_status(),
+                "search": search_status(),
+                "role": SERVER_ROLE,
+                "writer": writer_target() if SERVER_ROLE == "replica" else server_name,
+                "staleness_ms": replica_staleness_ms() if SERVER_ROLE == "replica" else 0,
+                **replication_metrics_snapshot(),
+            },
+        }
+
     elif service == "election":
         # Serviço para eleição de coordenador
         # Responde que está vivo e disponível para eleição
         clock = increment_clock()
         print(f"[SERVER] Requisição de eleição recebida de outro servidor")
-        # Não inicia eleição aqui para evitar loops - a thread de eleição vai cuidar disso
+        # O token de quem pediu entra no próximo mandato (fencing)
+        observe_token(request.get("data", {}).get("token", 0))
+        # Bully: quem tem prioridade maior responde e assume a eleição (em
+        # background, no máximo uma por vez, para não gerar loops). Réplica
+        # recusa: quem pediu segue como candidato
+        if SERVER_ROLE != "replica":
+            trigger_election()
         resp = {
             "service": "election",
             "data": {
-                "election": "OK",
+                "election": "OK" if SERVER_ROLE != "replica" else "RECUSADO",
                 "rank": server_rank,
                 "name": server_name,
+                "token": lease_status()["max_token"],
                 "timestamp": time.time(),
                 "clock": clock,
             },
@@ -800,11 +2920,11 @@ def handle_request(request, is_replication=False, pub_socket=None):
             },
         }
 
-    return resp, pub_info
+    return resp, pub_info, quorum
 
 
 # ---------- Subscriber para tópico "servers" ----------
-def server_subscriber_thread(pub_socket):
+def server_subscriber_thread():
     ctx = zmq.Context()
     sub = ctx.socket(zmq.SUB)
     sub.connect("tcp://proxy:5558")
@@ -814,41 +2934,74 @@ def server_subscriber_thread(pub_socket):
     
     while True:
         try:
-            frames = sub.recv_multipart()
-            if len(frames) < 2:
+            received = recv_multipart_msgpack(sub)
+            if received is None:
                 continue
-            topic = frames[0].decode()
-            payload = msgpack.unpackb(frames[1], raw=False)
+            topic, payload = received
             
-            if topic == "servers" and payload.get("service") == "election":
-                new_coord = payload.get("data", {}).get("coordinator")
-                received_clock = payload.get("data", {}).get("clock", 0)
+            if topic == "servers" and payload.get("service") in ("election", "lease"):
+                data = payload.get("data", {})
+                new_coord = data.get("coordinator")
+                received_clock = data.get("clock", 0)
                 update_clock(received_clock)
                 
-                with coordinator_lock:
-                    coordinator = new_coord
-                print(f"[SERVER] Novo coordenador: {new_coord}")
+                # Anúncios e renovações carregam o lease: o seguidor descobre
+                # a troca de coordenador por aqui, sem precisar consultar
+                accepted = accept_lease(
+                    new_coord,
+                    data.get("token", 0),
+                    data.get("rank"),
+                    data.get("lease", LEASE_DURATION),
+                )
+                if not accepted:
+                    print(f"[LEASE] Anúncio de {new_coord} rejeitado (token {data.get('token', 0)} antigo)")
         except Exception as e:
             print(f"[SERVER] Erro no subscriber: {e}")
 
 
 # ---------- Subscriber para tópico "replication" (Parte 5) ----------
+def refresh_mesh_peers(sub, connected, port=MESH_PORT, tag="MESH"):
+    """Conecta o SUB aos peers atuais (na porta dada) e desconecta os que saíram"""
+    peers = set(get_peers())
+    for peer in peers - connected:
+        sub.connect(f"tcp://{peer}:{port}")
+        print(f"[{tag}] Conectado a {peer}:{port}")
+    for peer in connected - peers:
+        try:
+            sub.disconnect(f"tcp://{peer}:{port}")
+        except zmq.ZMQError:
+            pass
+        print(f"[{tag}] Desconectado de {peer}")
+    return peers
+
+
 def replication_subscriber_thread():
     """Thread que recebe operações de replicação de outros servidores"""
     ctx = zmq.Context()
     sub = ctx.socket(zmq.SUB)
-    sub.connect("tcp://proxy:5558")
+    mesh_peers = set()
+    if REPLICATION_MESH:
+        mesh_peers = refresh_mesh_peers(sub, mesh_peers)
+    else:
+        sub.connect("tcp://proxy:5558")
     sub.setsockopt_string(zmq.SUBSCRIBE, "replication")
+    poller = zmq.Poller()
+    poller.register(sub, zmq.POLLIN)
+    last_refresh = time.time()
     
     print("[REPLICATION] Subscriber conectado ao tópico 'replication'")
     
     while True:
         try:
-            frames = sub.recv_multipart()
-            if len(frames) < 2:
+            if REPLICATION_MESH and time.time() - last_refresh > PEER_LIST_TTL:
+                mesh_peers = refresh_mesh_peers(sub, mesh_peers)
+                last_refresh = time.time()
+            if not poller.poll(1000):
+                continue
+            received = recv_multipart_msgpack(sub)
+            if received is None:
                 continue
-            topic = frames[0].decode()
-            payload = msgpack.unpackb(frames[1], raw=False)
+            topic, payload = received
             
             if topic == "replication":
                 # Atualiza relógio lógico
@@ -859,42 +3012,582 @@ def replication_subscriber_thread():
                 # Processa operação de replicação
                 service = payload.get("service")
                 if service and service.startswith("replicate_"):
-                    # Aplica a replicação diretamente
-                    operation = service.replace("replicate_", "")
-                    apply_replication(operation, payload.get("data", {}))
+                    # Durante o bootstrap guarda em buffer para aplicar após o snapshot
+                    with bootstrap_lock:
+                        if bootstrapping:
+                            bootstrap_buffer.append(payload)
+                            continue
+                    # A aplicação fica com a thread de apply (a fila mede o atraso)
+                    replication_queue.put((payload, time.time()))
         
         except Exception as e:
             print(f"[REPLICATION] Erro no subscriber: {e}")
 
 
+def replication_apply_thread():
+    """Aplica as operações da fila de replicação e registra as métricas"""
+    while True:
+        payload, received_at = replication_queue.get()
+        try:
+            data = payload.get("data", {})
+            operation = payload.get("service", "").replace("replicate_", "")
+            source = data.get("source", "unknown")
+            duplicate = is_already_applied(source, data.get("epoch"), data.get("seq"))
+            start = time.time()
+            with data_lock:
+                apply_replication(operation, data)
+            if source != server_name:
+                record_replication_metrics(source, data, received_at, start, time.time(), duplicate)
+        except Exception as e:
+            print(f"[REPLICATION] Erro ao aplicar operação da fila: {e}")
+
+
+# ---------- Métricas de replicação ----------
+def record_replication_metrics(source, data, received_at, started_at, applied_at, duplicate):
+    seq = data.get("seq")
+    epoch = data.get("epoch")
+    with metrics_lock:
+        m = replication_metrics.setdefault(source, {
+            "epoch": None,
+            "last_seq": None,
+            "applied": 0,
+            "duplicates": 0,
+            "gaps": 0,
+            "last_origin_ts": None,
+            "last_applied_at": None,
+            "lag_ms": 0.0,
+            "queue_ms": 0.0,
+            "apply_ms": 0.0,
+            "max_lag_ms": 0.0,
+            "recent": deque(),
+        })
+        if duplicate:
+            m["duplicates"] += 1
+            return
+        if seq is not None:
+            # Saltos na seq da mesma encarnação = operações perdidas no caminho
+            if m["epoch"] == epoch and m["last_seq"] is not None and seq > m["last_seq"] + 1:
+                m["gaps"] += seq - m["last_seq"] - 1
+            m["epoch"], m["last_seq"] = epoch, seq
+        origin_ts = data.get("timestamp")
+        lag_ms = (applied_at - origin_ts) * 1000 if origin_ts else 0.0
+        m["applied"] += 1
+        m["last_origin_ts"] = origin_ts
+        m["last_applied_at"] = applied_at
+        m["lag_ms"] = lag_ms
+        m["max_lag_ms"] = max(m["max_lag_ms"], lag_ms)
+        m["queue_ms"] = (started_at - received_at) * 1000
+        m["apply_ms"] = (applied_at - started_at) * 1000
+        m["recent"].append(applied_at)
+        while m["recent"] and applied_at - m["recent"][0] > RATE_WINDOW:
+            m["recent"].popleft()
+
+
+def replication_metrics_snapshot():
+    """Métricas atuais por origem, prontas para MsgPack/JSON"""
+    now = time.time()
+    peers = {}
+    with metrics_lock:
+        for source, m in replication_metrics.items():
+            while m["recent"] and now - m["recent"][0] > RATE_WINDOW:
+                m["recent"].popleft()
+            peers[source] = {
+                "epoch": m["epoch"],
+                "last_seq": m["last_seq"],
+                "applied": m["applied"],
+                "duplicates": m["duplicates"],
+                "gaps": m["gaps"],
+                "lag_ms": round(m["lag_ms"], 2),
+                "max_lag_ms": round(m["max_lag_ms"], 2),
+                "queue_ms": round(m["queue_ms"], 2),
+                "apply_ms": round(m["apply_ms"], 2),
+                "ops_per_sec": round(len(m["recent"]) / RATE_WINDOW, 2),
+                "idle_s": round(now - m["last_applied_at"], 1) if m["last_applied_at"] else None,
+            }
+    return {
+        "server": server_name,
+        "timestamp": now,
+        "queue_depth": replication_queue.qsize(),
+        "peers": peers,
+    }
+
+
+def dump_metrics():
+    """Grava uma amostra das métricas (tarefa do agendador a cada METRICS_INTERVAL)"""
+    try:
+        if os.path.exists(METRICS_FILE) and os.path.getsize(METRICS_FILE) > METRICS_MAX_BYTES:
+            os.replace(METRICS_FILE, METRICS_FILE + ".1")
+        with open(METRICS_FILE, "a") as f:
+            f.write(json.dumps(replication_metrics_snapshot()) + "\n")
+    except Exception as e:
+        print(f"[METRICS] Erro ao gravar métricas: {e}")
+
+
+# ---------- Transferência de estado (snapshot) ----------
+def capture_snapshot():
+    """Congela o estado atual em um blob MsgPack servido em chunks"""
+    # Lê a posição antes dos dados: toda operação contada na posição já foi
+    # salva, então o snapshot contém pelo menos essas operações (as extras
+    # são descartadas pela verificação de duplicatas na reaplicação)
+    position = replication_position()
+    data = load_data()
+    blob = pack({"data": data, "position": position})
+
+    now = time.time()
+    for snap_id in [sid for sid, s in snapshots.items() if now - s["created"] > SNAPSHOT_TTL]:
+        del snapshots[snap_id]
+    snap_id = uuid.uuid4().hex
+    snapshots[snap_id] = {"blob": blob, "created": now}
+    return snap_id, blob
+
+
+def snapshot_server_thread():
+    """Serve snapshots para réplicas novas (ROUTER, um chunk por pedido)"""
+    ctx = zmq.Context()
+    router = ctx.socket(zmq.ROUTER)
+    router.bind(f"tcp://*:{SNAPSHOT_PORT}")
+    print(f"[SNAPSHOT] ROUTER em tcp://*:{SNAPSHOT_PORT}")
+
+    while True:
+        try:
+            identity, raw = router.recv_multipart(copy=False)
+            req = unpack(raw, compressed=False)
+            service = req.get("service")
+            data = req.get("data", {})
+            received_clock = data.get("clock", 0)
+            if received_clock > 0:
+                update_clock(received_clock)
+
+            if service == "snapshot":
+                snap_id, blob = capture_snapshot()
+                print(f"[SNAPSHOT] Snapshot {snap_id[:8]} criado ({len(blob)} bytes)")
+                resp = {
+                    "service": "snapshot",
+                    "data": {
+                        "status": "sucesso",
+                        "id": snap_id,
+                        "size": len(blob),
+                        "chunk_size": SNAPSHOT_CHUNK_SIZE,
+                        "timestamp": time.time(),
+                        "clock": increment_clock(),
+                    },
+                }
+            elif service == "snapshot_chunk":
+                snap = snapshots.get(data.get("id"))
+                if not snap:
+                    resp = {
+                        "service": "snapshot_chunk",
+                        "data": {
+                            "status": "erro",
+                            "timestamp": time.time(),
+                            "clock": increment_clock(),
+                            "description": "Snapshot inexistente ou expirado",
+                        },
+                    }
+                else:
+                    offset = data.get("offset", 0)
+                    resp = {
+                        "service": "snapshot_chunk",
+                        "data": {
+                            "status": "sucesso",
+                            "offset": offset,
+                            "chunk": snap["blob"][offset:offset + SNAPSHOT_CHUNK_SIZE],
+                            "timestamp": time.time(),
+                            "clock": increment_clock(),
+                        },
+                    }
+            else:
+                resp = {
+                    "service": "error",
+                    "data": {
+                        "status": "erro",
+                        "timestamp": time.time(),
+                        "clock": increment_clock(),
+                        "description": "Serviço inválido",
+                    },
+                }
+            router.send_multipart([identity, compress_frame(pack(resp), req.get("compression"))], copy=False)
+        except Exception as e:
+            print(f"[SNAPSHOT] Erro no servidor de snapshot: {e}")
+
+
+def fetch_snapshot(peer):
+    """Baixa um snapshot do peer mantendo até SNAPSHOT_PIPELINE chunks em voo"""
+    ctx = zmq.Context()
+    dealer = ctx.socket(zmq.DEALER)
+    dealer.setsockopt(zmq.LINGER, 0)
+    dealer.connect(f"tcp://{peer}:{SNAPSHOT_PORT}")
+    poller = zmq.Poller()
+    poller.register(dealer, zmq.POLLIN)
+
+    def request(service, data):
+        data["clock"] = increment_clock()
+        send_msgpack(dealer, {"service": service, "data": data, "compression": SUPPORTED_COMPRESSION})
+
+    def reply():
+        if not poller.poll(SNAPSHOT_TIMEOUT):
+            raise TimeoutError(f"{peer} não respondeu em {SNAPSHOT_TIMEOUT}ms")
+        resp = recv_msgpack(dealer).get("data", {})
+        received_clock = resp.get("clock", 0)
+        if received_clock > 0:
+            update_clock(received_clock)
+        if resp.get("status") != "sucesso":
+            raise RuntimeError(resp.get("description", "erro no snapshot"))
+        return resp
+
+    try:
+        request("snapshot", {"timestamp": time.time()})
+        meta = reply()
+        snap_id, size, chunk_size = meta["id"], meta["size"], meta["chunk_size"]
+
+        chunks = {}
+        received = 0
+        next_offset = 0
+        in_flight = 0
+        while received < size:
+            # Cada chunk recebido libera um crédito para o próximo pedido
+            while in_flight < SNAPSHOT_PIPELINE and next_offset < size:
+                request("snapshot_chunk", {"id": snap_id, "offset": next_offset})
+                next_offset += chunk_size
+                in_flight += 1
+            resp = reply()
+            in_flight -= 1
+            chunks[resp["offset"]] = resp["chunk"]
+            received += len(resp["chunk"])
+
+        blob = b"".join(chunks[offset] for offset in sorted(chunks))
+        print(f"[SNAPSHOT] {size} bytes recebidos de {peer} em {len(chunks)} chunks")
+        return unpack(blob)
+    finally:
+        dealer.close()
+        ctx.term()
+
+
+def install_snapshot(snapshot):
+    """Substitui o estado local pelo snapshot e adota sua posição de replicação"""
+    data = snapshot.get("data", {})
+    data.setdefault("users", [])
+    data.setdefault("channels", [])
+    data.setdefault("subscriptions", {})
+    data.setdefault("messages", [])
+    with data_lock:
+        save_data(data)
+        rebuild_indexes(data)
+
+    with replication_lock:
+        for source, pos in snapshot.get("position", {}).items():
+            # A entrada do próprio nome é de uma encarnação anterior destes dados
+            if source != server_name:
+                replication_applied[source] = pos
+        save_replication_state()
+
+
+def needs_bootstrap():
+    data = load_data()
+    return not (data["users"] or data["channels"] or data["messages"])
+
+
+def bootstrap_from_peer():
+    """Carrega o estado de um peer saudável e passa para o fluxo de replicação"""
+    global bootstrapping
+    servers = sorted(get_server_list(), key=lambda s: s.get("rank", 999))
+    peers = [s.get("name") for s in servers if s.get("name") and s.get("name") != server_name]
+
+    if not peers:
+        print("[SNAPSHOT] Nenhum peer disponível, iniciando com estado vazio")
+    for peer in peers:
+        try:
+            print(f"[SNAPSHOT] Baixando estado de {peer}...")
+            start = time.time()
+            install_snapshot(fetch_snapshot(peer))
+            print(f"[SNAPSHOT] Estado de {peer} instalado em {time.time() - start:.2f}s")
+            break
+        except Exception as e:
+            print(f"[SNAPSHOT] Falha ao obter snapshot de {peer}: {e}")
+
+    # Aplica o que chegou durante a transferência (a partir da posição do
+    # snapshot) e só então libera o subscriber para o fluxo ao vivo
+    with bootstrap_lock:
+        for payload in bootstrap_buffer:
+            operation = payload.get("service", "").replace("replicate_", "")
+            with data_lock:
+                apply_replication(operation, payload.get("data", {}))
+        print(f"[SNAPSHOT] {len(bootstrap_buffer)} operações em buffer reaplicadas")
+        bootstrap_buffer.clear()
+        bootstrapping = False
+
+
+# ---------- Anti-entropia (digest Merkle) ----------
+def message_key(m):
+    """Canal ou conversa privada (independente da direção) da mensagem"""
+    if m.get("dst"):
+        return "dm:" + "|".join(sorted([str(m.get("src")), str(m.get("dst"))]))
+    return f"ch:{m.get('channel')}"
+
+
+def message_bucket(m):
+    return int(float(m.get("timestamp") or 0) // DIGEST_BUCKET_SECONDS)
+
+
+def message_identity(m):
+    """Hash de 64 bits do conteúdo da mensagem (o clock difere entre réplicas)"""
+    ident = [
+        m.get("user"),
+        m.get("src"),
+        m.get("dst"),
+        m.get("channel"),
+        m.get("message"),
+        round(float(m.get("timestamp") or 0), 3),
+    ]
+    digest = hashlib.sha1(msgpack.packb(ident, use_bin_type=True)).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def message_stored(data, msg):
+    """Verdadeiro se a mensagem já está gravada (mesma identidade do digest,
+    comparada só dentro do canal/conversa e bucket dela)"""
+    key, bucket, ident = message_key(msg), message_bucket(msg), message_identity(msg)
+    return any(
+        message_key(m) == key and message_bucket(m) == bucket and message_identity(m) == ident
+        for m in data.get("messages", [])
+    )
+
+
+def digest_add(m):
+    """Soma a mensagem ao bucket (soma mod 2^64: independe da ordem de chegada)"""
+    key, bucket, h = message_key(m), message_bucket(m), message_identity(m)
+    with digest_lock:
+        entry = message_digest.setdefault(key, {}).setdefault(bucket, [0, 0])
+        entry[0] = (entry[0] + h) & 0xFFFFFFFFFFFFFFFF
+        entry[1] += 1
+
+
+def rebuild_digest(data):
+    with digest_lock:
+        message_digest.clear()
+    for m in data.get("messages", []):
+        digest_add(m)
+
+
+def hash_obj(obj):
+    return hashlib.sha1(msgpack.packb(obj, use_bin_type=True)).hexdigest()
+
+
+def digest_buckets(keys):
+    """{chave: {bucket: [soma, qtd]}} (buckets como str para o MsgPack)"""
+    with digest_lock:
+        return {
+            key: {str(b): list(v) for b, v in message_digest.get(key, {}).items()}
+            for key in keys
+        }
+
+
+def digest_summary(data):
+    """Raiz da árvore, hash de usuários/canais/inscrições e hash por chave"""
+    with digest_lock:
+        keys = {
+            key: hash_obj(sorted(buckets.items()))
+            for key, buckets in message_digest.items()
+        }
+    meta = hash_obj([
+        sorted(data["users"]),
+        sorted(data["channels"]),
+        sorted((u, sorted(chs)) for u, chs in data["subscriptions"].items()),
+        sorted(
+            (u, sorted((kind, sorted(names.items())) for kind, names in cursors.items()))
+            for u, cursors in data.get("read_cursors", {}).items()
+        ),
+        sorted(data.get("delivered", {}).items()),
+    ])
+    return {"root": hash_obj([meta, sorted(keys.items())]), "meta": meta, "keys": keys}
+
+
+def request_peer(peer, service, data, timeout=PEER_TIMEOUT):
+    return get_peer_connection(peer).request(service, data, timeout).get("data", {})
+
+
+def merge_meta(remote):
+    """União de usuários, canais e inscrições e maior cursor de leitura (nunca remove nada)"""
+    with data_lock:
+        data = load_data()
+        changed = 0
+        for user in remote.get("users", []):
+            if user not in data["users"]:
+                data["users"].append(user)
+                changed += 1
+        for ch in remote.get("channels", []):
+            if ch not in data["channels"]:
+                data["channels"].append(ch)
+                changed += 1
+        for user, chs in remote.get("subscriptions", {}).items():
+            user_subs = data["subscriptions"].setdefault(user, [])
+            for ch in chs:
+                if ch not in user_subs:
+                    user_subs.append(ch)
+                    changed += 1
+        for user, cursors in remote.get("read_cursors", {}).items():
+            for kind, names in cursors.items():
+                for name, cursor in names.items():
+                    changed += set_read_cursor(data, user, kind, name, cursor)
+        for user, cursor in remote.get("delivered", {}).items():
+            changed += inbox_ack(data, user, cursor)
+        if changed:
+            save_data(data)
+            bump_version("users")
+            bump_version("channels")
+        return changed
+
+
+def merge_messages(messages):
+    """Insere as mensagens do peer que faltam localmente"""
+    with data_lock:
+        data = load_data()
+        wanted = {(message_key(m), message_bucket(m)) for m in messages}
+        known = {
+            message_identity(m) for m in data["messages"]
+            if (message_key(m), message_bucket(m)) in wanted
+        }
+        added = 0
+        for m in messages:
+            ident = message_identity(m)
+            if ident not in known:
+                data["messages"].append(m)
+                index_message(m)
+                known.add(ident)
+                added += 1
+        if added:
+            save_data(data)
+        return added
+
+
+def anti_entropy_round(peer):
+    """Compara digests com o peer descendo só pelos ramos divergentes"""
+    remote = request_peer(peer, "digest", {})
+    local = digest_summary(load_data())
+    if remote.get("root") == local["root"]:
+        return 0
+
+    repaired = 0
+    if remote.get("meta") != local["meta"]:
+        repaired += merge_meta(request_peer(peer, "digest_fetch", {"meta": True}))
+
+    remote_keys = remote.get("keys", {})
+    diff_keys = [k for k, h in remote_keys.items() if local["keys"].get(k) != h]
+    if not diff_keys:
+        return repaired
+
+    remote_buckets = request_peer(peer, "digest", {"keys": diff_keys}).get("buckets", {})
+    local_buckets = digest_buckets(diff_keys)
+    for key, buckets in remote_buckets.items():
+        diff = [b for b, v in buckets.items() if local_buckets.get(key, {}).get(b) != v]
+        if diff:
+            fetched = request_peer(peer, "digest_fetch", {"key": key, "buckets": diff})
+            repaired += merge_messages(fetched.get("messages", []))
+    return repaired
+
+
+def anti_entropy_tick():
+    """Compara o estado com um peer aleatório e repara diferenças (tarefa do
+    agendador a cada ANTI_ENTROPY_INTERVAL)"""
+    if bootstrapping:
+        return
+    peers = get_peers()
+    if not peers:
+        return
+    peer = random.choice(peers)
+    try:
+        repaired = anti_entropy_round(peer)
+        if repaired:
+            print(f"[ANTI-ENTROPY] {repaired} itens reparados a partir de {peer}")
+    except Exception as e:
+        print(f"[ANTI-ENTROPY] Erro ao comparar com {peer}: {e}")
+
+
 # ---------- main ----------
+def serve_request(req):
+    """Atende um pedido do REP: (corpo pronto para enviar, publicação pendente)"""
+    # Réplica: escritas (e leituras que exigem dados mais novos) vão ao writer
+    resp, pub_info, quorum = route_request(req), None, None
+    raw = None
+    if resp is None:
+        with data_lock:
+            # Leitura repetida sem mudança nos dados: corpo pronto do cache
+            raw = cached_reply(req)
+            if raw is None:
+                version = response_version(req)
+                resp, pub_info, quorum = handle_request(req, is_replication=False)
+                if version is not None:
+                    # Guardada no cache: o corpo já sai pronto, sem codificar de novo
+                    raw = store_reply(req, version, resp)
+        if quorum:
+            # Acks esperados sem o data_lock: a replicação recebida continua
+            # sendo aplicada e confirmada enquanto isso
+            apply_write_concern(resp, *quorum)
+        if raw is None and SERVER_ROLE == "replica" and req.get("service") in READ_SERVICES:
+            resp.setdefault("data", {})["staleness_ms"] = replica_staleness_ms()
+    if raw is None:
+        raw = pack(resp)
+    # Resposta grande vai comprimida se o pedido anunciou suporte
+    return compress_frame(raw, req.get("compression")), pub_info
+
+
 def main():
-    global server_rank, coordinator
+    global server_rank, coordinator, bootstrapping
     
     os.makedirs(DATA_DIR, exist_ok=True)
-    ctx = zmq.Context()
+    load_replication_state()
+    load_lease_token()
+    # Diretório de dados vazio: replicações ficam em buffer até o snapshot chegar
+    bootstrapping = needs_bootstrap()
+    rebuild_indexes(load_data())
+    ctx = zmq.Context.instance()  # Compartilhado com o inproc do publicador
 
     rep = ctx.socket(zmq.REP)
     rep.bind("tcp://*:5555")
-    print(f"[SERVER] REP em tcp://*:5555 (nome: {server_name})")
+    print(f"[SERVER] REP em tcp://*:5555 (nome: {server_name}, papel: {SERVER_ROLE})")
 
-    pub = ctx.socket(zmq.PUB)
-    pub.connect("tcp://proxy:5557")
+    # Todos os PUBs pertencem à thread do publicador; as demais threads
+    # publicam via inproc (publish)
+    routes = {}
+    routes["proxy"] = ctx.socket(zmq.PUB)
+    routes["proxy"].connect("tcp://proxy:5557")
     print("[SERVER] PUB -> proxy tcp://proxy:5557")
+    routes["heartbeat"] = ctx.socket(zmq.PUB)
+    routes["heartbeat"].bind(f"tcp://*:{HEARTBEAT_PORT}")
+    if REPLICATION_MESH:
+        routes["mesh"] = ctx.socket(zmq.PUB)
+        routes["mesh"].bind(f"tcp://*:{MESH_PORT}")
+        print(f"[MESH] PUB de replicação em tcp://*:{MESH_PORT}")
+    pull = ctx.socket(zmq.PULL)
+    pull.bind(PUBLISHER_ADDR)
+    threading.Thread(target=publisher_thread, args=(pull, routes), daemon=True).start()
 
     # Obtém rank do serviço de referência
     print("[SERVER] Obtendo rank do serviço de referência...")
     get_rank_from_reference()
+    refresh_peers()
     
     # Inicia threads de background
-    threading.Thread(target=heartbeat_thread, daemon=True).start()
-    threading.Thread(target=sync_thread, daemon=True).start()
-    threading.Thread(target=server_subscriber_thread, args=(pub,), daemon=True).start()
-    threading.Thread(target=election_thread, daemon=True).start()
+    # Manutenção periódica em um único agendador (fora do caminho dos pedidos)
+    scheduler.add_job("heartbeat", send_heartbeat, HEARTBEAT_REFERENCE_INTERVAL)
+    scheduler.add_job("berkeley", sync_physical_clock, BERKELEY_INTERVAL)
+    scheduler.add_job("metrics_dump", dump_metrics, METRICS_INTERVAL)
+    scheduler.add_job("anti_entropy", anti_entropy_tick, ANTI_ENTROPY_INTERVAL)
+    scheduler.add_job("search_persist", search_save, SEARCH_PERSIST_INTERVAL)
+    scheduler.add_job("peer_refresh", refresh_peers, PEER_LIST_TTL)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    threading.Thread(target=server_subscriber_thread, daemon=True).start()
+    threading.Thread(target=lease_thread, daemon=True).start()
+    threading.Thread(target=failure_detector_thread, daemon=True).start()
     threading.Thread(target=replication_subscriber_thread, daemon=True).start()
+    threading.Thread(target=replication_apply_thread, daemon=True).start()
+    threading.Thread(target=snapshot_server_thread, daemon=True).start()
+    threading.Thread(target=quorum_ack_thread, daemon=True).start()
     
     # Aguarda um pouco antes de iniciar eleição
     time.sleep(3)
+    if bootstrapping:
+        bootstrap_from_peer()
     if server_rank is not None:
         start_election()
     else:
@@ -903,14 +3596,20 @@ def main():
     print("[SERVER] Online (MsgPack + Relógios + Replicação).")
 
     while True:
-        req = recv_msgpack(rep)
-        resp, pub_info = handle_request(req, is_replication=False, pub_socket=pub)
-        send_msgpack(rep, resp)
+        req = None
+        try:
+            # Pedidos de clientes nunca vêm comprimidos (só respostas)
+            req = recv_msgpack(rep, compressed=False)
+            raw, pub_info = serve_request(req)
+        except Exception as e:
+            # Pedido malformado não derruba o servidor: o REP sempre responde
+            print(f"[SERVER] Erro ao atender pedido {req!r:.200}: {e!r}")
+            raw, pub_info = pack(error_response(req, f"Pedido inválido: {str(e) or type(e).__name__}")), None
+        send_packed(rep, raw)
 
         if pub_info:
             topic, payload = pub_info
-            packed = msgpack.packb(payload, use_bin_type=True)
-            pub.send_multipart([topic.encode(), packed])
+            publish(topic, payload, route="coalesce" if PUBLISH_COALESCE_MS > 0 else "proxy")
 
 
 if __name__ == "__main__":
@@ -118,6 +118,12 @@ async function doLogin(username) {
     loginOverlay.classList.remove("active");
 
     logEvent(`Login realizado como '${username}'.`);
+    // Mensagens privadas recebidas enquanto estava offline
+    const inbox = reply?.data?.inbox || [];
+    if (inbox.length) {
+      logEvent(`${inbox.length} mensagens privadas recebidas enquanto offline:`);
+      inbox.forEach((m) => logEvent(`[PRIVADA de ${m.src || m.user}] ${m.message}`));
+    }
 
     await loadChannels();
     await loadUsers();
@@ -132,6 +138,16 @@ loginBtn.addEventListener("click", () => {
   doLogin(loginUsernameInput.value);
 });
 
+// Ao sair da página, confirma as mensagens privadas já vistas ao vivo (senão
+// todo login depois de um reload as repetiria como recebidas offline)
+window.addEventListener("pagehide", () => {
+  if (!currentUser) return;
+  navigator.sendBeacon(
+    "/api/logout",
+    new Blob([JSON.stringify({ user: currentUser })], { type: "application/json" })
+  );
+});
+
 loginUsernameInput.addEventListener("keydown", (e) => {
   if (e.key === "Enter") doLogin(loginUsernameInput.value);
 });
@@ -238,14 +254,28 @@ async function selectChannel(ch) {
   logEvent(`Entrando em #${ch}...`);
 
   try {
+    // Já visitado: mostra o que está em memória e busca só o que chegou depois
+    const cached = channelHistory.get(ch);
+    const query = cached?.cursor
+      ? `&since=${encodeURIComponent(JSON.stringify(cached.cursor))}`
+      : "";
     const reply = await fetchJSON(
-      `/api/history?channel=${encodeURIComponent(ch)}`
+      `/api/history?channel=${encodeURIComponent(ch)}${query}`
     );
-    const msgs = reply?.data?.messages || [];
-    msgs
+    const entry = cached || { messages: [], keys: new Set(), cursor: null };
+    // O cursor relê uma janela curta antes dele: ignora o que já veio ao vivo
+    const msgs = (reply?.data?.messages || []).filter(
+      (m) => !entry.keys.has(historyKey(m))
+    );
+    msgs.forEach((m) => entry.keys.add(historyKey(m)));
+    entry.messages.push(...msgs);
+    if (reply?.data?.cursor) entry.cursor = reply.data.cursor;
+    channelHistory.set(ch, entry);
+    if (activeChannel !== ch) return; // Trocou de canal durante o pedido
+    entry.messages
       .sort((a, b) => (a.timestamp || 0) - (b.timestamp || 0))
       .forEach((m) => renderMessage(m, ch));
-    logEvent(`Histórico de #${ch} carregado (${msgs.length} mensagens).`);
+    logEvent(`Histórico de #${ch} carregado (${msgs.length} mensagens novas).`);
   } catch {
     logEvent(`Erro ao carregar histórico de #${ch}.`);
   }
@@ -405,6 +435,21 @@ messageInput.addEventListener("keydown", (e) => {
 // ---------- Renderizar mensagens ----------
 // Cache de mensagens já renderizadas para evitar duplicatas
 const renderedMessages = new Set();
+// Histórico por canal já baixado + cursor (devolvido pelo servidor) para
+// buscar só as novas
+const channelHistory = new Map();
+
+function historyKey(msg) {
+  // O clock muda entre réplicas; autor, texto e timestamp não
+  return `${msg.user}_${msg.message}_${msg.timestamp}`;
+}
+
+function rememberChannelMessage(msg) {
+  const entry = channelHistory.get(msg.channel || msg.topic);
+  if (!entry || msg.dst || entry.keys.has(historyKey(msg))) return;
+  entry.keys.add(historyKey(msg));
+  entry.messages.push(msg);
+}
 
 function getMessageId(msg) {
   const { src, dst, user, channel, message, timestamp, clock } = msg;
@@ -552,6 +597,7 @@ es.addEventListener("message", (e) => {
           renderMessage(data);
         }
       } else {
+        rememberChannelMessage(data);
         // Mensagem de canal - só renderiza se não estiver visualizando conversa privada
         if (!activeChannelTitle.textContent.includes("Conversa privada")) {
           renderMessage(data);
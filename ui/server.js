@@ -126,22 +126,28 @@ function broadcast(event, data) {
         const topic = topicBuf.toString();
         const decoded = decode(payloadBuf); // {user, channel, message, timestamp, clock, service, coordinator}
 
-        // Atualiza relógio lógico ao receber mensagem
-        const receivedClock = decoded.clock || 0;
-        if (receivedClock > 0) {
-          updateClock(receivedClock);
-        }
+        // O servidor pode agrupar várias mensagens do tópico em um lote
+        const messages =
+          decoded.service === "batch" ? (decoded.data?.messages || []) : [decoded];
+
+        for (const item of messages) {
+          // Atualiza relógio lógico ao receber mensagem
+          const receivedClock = item.clock || 0;
+          if (receivedClock > 0) {
+            updateClock(receivedClock);
+          }
 
-        const enriched = {
-          topic,
-          ...decoded,
-        };
+          const enriched = {
+            topic,
+            ...item,
+          };
 
-        console.log("[UI][SUB] Recebido do proxy:", enriched);
+          console.log("[UI][SUB] Recebido do proxy:", enriched);
 
-        // Envia para todos os clientes SSE (usado no chat + debug)
-        // Inclui mensagens de canais e anúncios de coordenador
-        broadcast("message", enriched);
+          // Envia para todos os clientes SSE (usado no chat + debug)
+          // Inclui mensagens de canais e anúncios de coordenador
+          broadcast("message", enriched);
+        }
       } catch (err) {
         console.error("[UI][SUB] Erro ao decodificar MessagePack:", err);
       }
@@ -170,6 +176,20 @@ app.post("/api/login", async (req, res) => {
   }
 });
 
+// Logout: o que chegou ao vivo não volta como "offline" no próximo login
+app.post("/api/logout", async (req, res) => {
+  const { user } = req.body || {};
+  if (!user) return res.status(400).json({ error: "user required" });
+
+  try {
+    const reply = await rpc("logout", { user });
+    return res.json(reply);
+  } catch (err) {
+    console.error("[UI][API][logout] Erro:", err);
+    return res.status(500).json({ error: "failed" });
+  }
+});
+
 // Lista de usuários
 app.get("/api/users", async (_req, res) => {
   try {
@@ -250,11 +270,20 @@ app.post("/api/message", async (req, res) => {
 
 // Histórico por canal
 app.get("/api/history", async (req, res) => {
-  const { channel } = req.query;
+  const { channel, since } = req.query;
   if (!channel) return res.status(400).json({ error: "channel required" });
 
   try {
-    const reply = await rpc("history", { channel });
+    // "since" = cursor devolvido no pedido anterior, em JSON (só mensagens mais novas)
+    const payload = { channel };
+    if (since !== undefined) {
+      try {
+        payload.since = JSON.parse(since);
+      } catch {
+        return res.status(400).json({ error: "since inválido" });
+      }
+    }
+    const reply = await rpc("history", payload);
     return res.json(reply);
   } catch (err) {
     console.error("[UI][API][history] Erro:", err);